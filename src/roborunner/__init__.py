@@ -1,7 +1,31 @@
+from importlib import import_module
 
-from .run import run
+# run, config and device import no robot machinery and are bound up front,
+# which also keeps roborunner.run the function after roborunner.run the
+# module was imported
+from .run import run, run_suites
 from .config import Config
 from .device import Device, BuildDeviceList
-from .executable_test_suite import ExecutableTestSuite, BuildExecutableTestSuites
-from .log_tree import SuiteLogTree, DeviceLogTree
-from .test_suite_executor import TestSuiteExecutor
+
+# the other public names and their modules, imported when they are first
+# used, so that importing roborunner, e.g. in every job process, does not
+# import all of robot's running and result machinery up front
+_exports = {
+    'ExecutableTestSuite': 'executable_test_suite',
+    'BuildExecutableTestSuites': 'executable_test_suite',
+    'JobResult': 'job_result',
+    'RunSummary': 'job_result',
+    'SuiteLogTree': 'log_tree',
+    'DeviceLogTree': 'log_tree',
+    'WorkerResults': 'log_tree',
+    'write_log_trees': 'log_tree',
+    'TestSuiteExecutor': 'test_suite_executor'
+}
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+    value = getattr(import_module('.' + _exports[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -1,4 +1,4 @@
-from roborunner import run
+from roborunner.run import run
 from sys import argv
 
 if __name__ == "__main__":
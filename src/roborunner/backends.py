@@ -0,0 +1,629 @@
+from roborunner.config import set_process_config
+from roborunner.executable_test_suite import run_job
+from roborunner.job_result import JobResult
+from roborunner import session
+
+from robot.api import logger
+
+from multiprocessing import AuthenticationError, Event, Lock as ProcessLock, Process, Pipe, SimpleQueue
+from multiprocessing.connection import Listener, deliver_challenge, answer_challenge
+from multiprocessing.pool import Pool
+from subprocess import Popen, PIPE, TimeoutExpired
+from threading import Thread, Lock
+from time import time
+from os import path, makedirs
+import json
+import os
+import pickle
+import signal
+import sys
+
+# seconds a timed out job gets to write its output after SIGTERM before it is killed
+KILL_GRACE_PERIOD = 10
+# seconds a connecting worker has to send its hello after authenticating
+HANDSHAKE_TIMEOUT = 10
+
+
+# the pool of this process reports to, set by _start_pool_worker in every pool worker
+_pool_state = None
+
+
+def _start_pool_worker(config, state):
+    global _pool_state
+    set_process_config(config)
+    _pool_state = state
+
+
+def _run_pool_job(job, events):
+    """
+    Runs a job in a pool worker, which reports its pid as busy while the job runs
+    """
+    lock, stopping, busy = _pool_state
+    with lock:
+        if stopping.is_set():
+            raise RuntimeError('the pool was stopped before the job started')
+        busy.put((os.getpid(), True))
+    try:
+        return run_job(job, events)
+    finally:
+        with lock:
+            busy.put((os.getpid(), False))
+
+
+class PoolBackend:
+    """
+    Runs each job in a worker of a multiprocessing pool. Jobs cannot
+    be timed out individually; terminate() stops the whole pool.
+    The workers get the config once when they start, and a Job per job.
+    """
+
+    def __init__(self, config, events):
+        self.config = config
+        self.events = events
+        # the workers report when they start and finish a job, so terminate()
+        # knows which of them run a job
+        self._state = (ProcessLock(), Event(), SimpleQueue())
+        self.pool = Pool(
+            processes=config['max_processes'],
+            initializer=_start_pool_worker,
+            initargs=(config, self._state)
+        )
+
+    def submit(self, suite, callback, error_callback, timeout=None):
+        return self.pool.apply_async(
+            _run_pool_job,
+            args=(suite.job, self.events),
+            callback=callback,
+            error_callback=error_callback
+        )
+
+    def terminate(self):
+        # robot handles SIGTERM by stopping gracefully, after which the worker
+        # would take the next job, so the workers that run a job are killed.
+        # Idle workers are left to pool.terminate(), an idle worker holds the
+        # lock of the task queue while it waits and must not be killed
+        lock, stopping, busy = self._state
+        with lock:
+            stopping.set()
+            running = set()
+            while not busy.empty():
+                pid, started = busy.get()
+                if started:
+                    running.add(pid)
+                else:
+                    running.discard(pid)
+            for pid in running:
+                try:
+                    os.kill(pid, getattr(signal, 'SIGKILL', signal.SIGTERM))
+                except OSError:
+                    pass
+        self.pool.terminate()
+        self.pool.join()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class JobThreadBackend:
+    """
+    Base of the backends that hand every job to a process from a thread of
+    its own, which waits for the job within its timeout and reports its
+    result. Subclasses start the job with _start, wait for it with _wait,
+    stop it at its timeout with _stop, read its result with _read and
+    release what _start returned with _release. Jobs that are stopped at
+    the deadline of the run are not reported, the executor fails them.
+    """
+
+    def __init__(self, config, events):
+        self.config = config
+        self.events = events
+        self._threads = []
+        self._lock = Lock()
+        self._terminated = False
+
+    def submit(self, suite, callback, error_callback, timeout=None):
+        thread = Thread(
+            name='job_{}'.format(suite.job_name),
+            target=self._run_job,
+            args=(suite, callback, error_callback, timeout),
+            daemon=True
+        )
+        self._threads.append(thread)
+        thread.start()
+        return thread
+
+    def _run_job(self, suite, callback, error_callback, timeout):
+        try:
+            started = time()
+            job = self._start(suite)
+            try:
+                if self._wait(job, timeout):
+                    result = self._read(suite, job, started)
+                else:
+                    logger.error('{} did not finish within {} seconds, stopping it'
+                                 .format(suite.job_name, timeout))
+                    if self._stop(job):
+                        result = self._read(suite, job, started)
+                    else:
+                        result = suite.write_failed_result(
+                            'Job was killed after exceeding its timeout of {} seconds'.format(timeout)
+                        )
+            finally:
+                self._release(suite, job)
+        except Exception as e:
+            if not self._terminated:
+                error_callback(e)
+            return
+        if not self._terminated:
+            callback(result)
+
+    def _start(self, suite):
+        raise NotImplementedError()
+
+    def _wait(self, job, timeout):
+        """
+        :return: True if the job finished, False if it ran into its timeout
+        """
+        raise NotImplementedError()
+
+    def _stop(self, job):
+        """
+        :return: True if the job still wrote its result, False if it was killed
+        """
+        raise NotImplementedError()
+
+    def _read(self, suite, job, started):
+        raise NotImplementedError()
+
+    def _release(self, suite, job):
+        pass
+
+    def _join_threads(self):
+        for thread in self._threads:
+            thread.join()
+
+
+class SubprocessBackend(JobThreadBackend):
+    """
+    Runs each job in its own python process (see roborunner.job), started
+    and watched by a thread. A job running longer than its timeout is sent
+    SIGTERM, which lets robot stop and write its output, and is killed
+    when it does not exit within KILL_GRACE_PERIOD seconds. Jobs that are
+    killed get an output in which all their tests failed.
+    """
+
+    def __init__(self, config, events):
+        super().__init__(config, events)
+        self._processes = {}
+
+    def _forward_events(self, stream, job_results):
+        """
+        Forwards the progress events of a job, and keeps the JobResult
+        that the job sends as its last line
+        """
+        for line in stream:
+            try:
+                event = json.loads(line.decode('utf-8'))
+            except ValueError:
+                logger.info('unexpected output from job: {}'.format(line))
+                continue
+            if event.get('event') == 'job_result':
+                job_results.append(JobResult(**event['result']))
+            else:
+                self.events.put(event)
+
+    @staticmethod
+    def _signal(process, signal_number):
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(process.pid, signal_number)
+            else:
+                process.kill()
+        except OSError:
+            pass
+
+    def _start(self, suite):
+        process = Popen(
+            [sys.executable, '-m', 'roborunner.job'],
+            stdin=PIPE,
+            stdout=PIPE,
+            start_new_session=True
+        )
+        with self._lock:
+            self._processes[id(suite)] = process
+        job_results = []
+        reader = Thread(target=self._forward_events, args=(process.stdout, job_results), daemon=True)
+        reader.start()
+        process.stdin.write(pickle.dumps((self.config, suite.job)))
+        process.stdin.close()
+        return process, reader, job_results
+
+    def _wait(self, job, timeout):
+        process, reader, _ = job
+        try:
+            process.wait(timeout=timeout)
+        except TimeoutExpired:
+            return False
+        reader.join()
+        return True
+
+    def _stop(self, job):
+        process, reader, _ = job
+        self._signal(process, signal.SIGTERM)
+        try:
+            process.wait(timeout=KILL_GRACE_PERIOD)
+            stopped = True
+        except TimeoutExpired:
+            self._signal(process, getattr(signal, 'SIGKILL', signal.SIGTERM))
+            process.wait()
+            stopped = False
+        reader.join()
+        return stopped
+
+    def _read(self, suite, job, started):
+        process, _, job_results = job
+        result_path = suite.result_path
+        if not job_results or not path.exists(result_path) or path.getmtime(result_path) < started:
+            return suite.write_failed_result(
+                'Job process exited with code {} without writing an output'.format(process.returncode)
+            )
+        return job_results[-1]
+
+    def _release(self, suite, job):
+        with self._lock:
+            self._processes.pop(id(suite), None)
+
+    def terminate(self):
+        self._terminated = True
+        with self._lock:
+            processes = list(self._processes.values())
+        for process in processes:
+            self._signal(process, getattr(signal, 'SIGKILL', signal.SIGTERM))
+        self.close()
+
+    def close(self):
+        self._join_threads()
+
+
+def _serve_device(connection, config, device, events):
+    """
+    Runs the jobs of one device that arrive on the connection one after
+    another, until it receives None or the connection is closed
+    """
+    set_process_config(config)
+    if config.get('session_hook'):
+        session.start(config['session_hook'], device)
+    try:
+        while True:
+            try:
+                job = connection.recv()
+            except EOFError:
+                break
+            if job is None:
+                break
+            session.begin_job()
+            try:
+                connection.send(('result', run_job(job, events=events)))
+            except Exception as e:
+                connection.send(('error', '{}: {}'.format(type(e).__name__, e)))
+    finally:
+        session.stop()
+
+
+class DeviceWorker:
+    """
+    A process pinned to one device, which keeps the libraries its suites
+    imported and the device session of --session-hook between jobs
+    """
+
+    def __init__(self, config, device, events):
+        self.device = device
+        self.busy = False
+        self.connection, child = Pipe()
+        self.process = Process(
+            target=_serve_device,
+            args=(child, config, device, events),
+            name='device_{}'.format(device['name']),
+            daemon=True
+        )
+        self.process.start()
+        child.close()
+
+
+class DeviceBackend(JobThreadBackend):
+    """
+    Runs the jobs of every device on long-lived processes pinned to that
+    device, one process per slot of the device, started with its first job.
+    A process runs one job at a time, so a device session opened by one suite
+    can be used by the next (see roborunner.session). A job running longer
+    than its timeout is killed together with its process, the next job of
+    the device starts a new one.
+    """
+
+    def __init__(self, config, events):
+        super().__init__(config, events)
+        self._workers = {}
+        if config.get('session_hook'):
+            # fails the run right away when the hook cannot be imported
+            session.load_hook(config['session_hook'])
+
+    def _start(self, suite):
+        device = str(suite)
+        with self._lock:
+            workers = self._workers.setdefault(device, [])
+            idle = [worker for worker in workers if not worker.busy and worker.process.is_alive()]
+            if idle:
+                worker = idle[0]
+            else:
+                # workers killed at their timeout or exited on their own are replaced
+                for dead in [worker for worker in workers if not worker.busy and not worker.process.is_alive()]:
+                    dead.connection.close()
+                    workers.remove(dead)
+                worker = DeviceWorker(self.config, dict(suite), self.events)
+                workers.append(worker)
+                logger.info('started worker {} for device {}'.format(worker.process.pid, device))
+            worker.busy = True
+        try:
+            worker.connection.send(suite.job)
+        except (OSError, EOFError) as e:
+            worker.busy = False
+            raise RuntimeError('the worker of device {} exited: {}'.format(device, e))
+        return worker
+
+    def _wait(self, worker, timeout):
+        return worker.connection.poll(timeout)
+
+    def _stop(self, worker):
+        worker.process.kill()
+        worker.process.join()
+        return False
+
+    def _read(self, suite, worker, started):
+        try:
+            kind, value = worker.connection.recv()
+        except (OSError, EOFError) as e:
+            raise RuntimeError('the worker of device {} exited: {}'.format(str(suite), e))
+        if kind != 'result':
+            raise RuntimeError(value)
+        return value
+
+    def _release(self, suite, worker):
+        worker.busy = False
+
+    def _stop_workers(self, kill):
+        with self._lock:
+            workers = [worker for device_workers in self._workers.values() for worker in device_workers]
+        for worker in workers:
+            if kill:
+                worker.process.kill()
+            else:
+                try:
+                    worker.connection.send(None)
+                except (OSError, ValueError):
+                    pass
+        for worker in workers:
+            worker.process.join()
+
+    def terminate(self):
+        self._terminated = True
+        self._stop_workers(kill=True)
+
+    def close(self):
+        self._join_threads()
+        self._stop_workers(kill=False)
+
+
+def parse_address(address):
+    """
+    :param address: `host:port`
+    :return: a (host, port) tuple for multiprocessing.connection
+    """
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class RemoteWorker:
+    """
+    Connection of the coordinator to one `roborunner worker`
+    """
+
+    def __init__(self, connection, name, devices):
+        self.connection = connection
+        self.name = name
+        self.devices = set(devices)
+        self.jobs = []
+        self._send_lock = Lock()
+
+    def send(self, message):
+        with self._send_lock:
+            self.connection.send(message)
+
+    def close(self):
+        try:
+            self.connection.close()
+        except OSError:
+            pass
+
+
+class RemoteBackend:
+    """
+    Hands jobs out over TCP to `roborunner worker` processes, which may run
+    on other hosts (see roborunner.worker). Every worker declares the devices
+    it owns and only gets the jobs of those devices. Workers run their jobs
+    like the subprocess executor, including --job-timeout, and send back
+    the events, the output files and the JobResult of every job. The jobs
+    of a worker that disconnects are requeued.
+    """
+
+    def __init__(self, config, events):
+        self.config = config
+        self.events = events
+        self._jobs = {}
+        self._pending = []
+        self._workers = []
+        self._waiting_for = set()
+        self._lock = Lock()
+        self._closed = False
+        if not config.get('authkey'):
+            raise ValueError('the remote executor requires --authkey or $ROBORUNNER_AUTHKEY')
+        self._authkey = config['authkey'].encode('utf-8')
+        # connections are authenticated by their own handshake thread,
+        # so a client that stalls does not keep other workers out
+        self._listener = Listener(parse_address(config['listen']))
+        Thread(name='remote_accept', target=self._accept, daemon=True).start()
+        logger.info('waiting for workers on {}'.format(config['listen']), also_console=True)
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                connection = self._listener.accept()
+            except OSError as e:
+                if not self._closed:
+                    logger.info('a worker could not connect: {}'.format(e))
+                continue
+            if self._closed:
+                # a blocked accept() is not interrupted by closing the listener
+                connection.close()
+                return
+            Thread(name='remote_handshake', target=self._handshake, args=(connection,), daemon=True).start()
+
+    def _handshake(self, connection):
+        """
+        Authenticates a connection like Listener does with an authkey, then
+        waits for the hello of the worker before anything is unpickled
+        """
+        try:
+            deliver_challenge(connection, self._authkey)
+            answer_challenge(connection, self._authkey)
+            if not connection.poll(HANDSHAKE_TIMEOUT):
+                raise TimeoutError('no hello within {} seconds'.format(HANDSHAKE_TIMEOUT))
+            _, name, devices = connection.recv()
+        except (OSError, EOFError, ValueError, AuthenticationError) as e:
+            if not self._closed:
+                logger.info('a worker could not connect: {}'.format(e))
+            connection.close()
+            return
+        worker = RemoteWorker(connection, name, devices)
+        try:
+            worker.send(('config', self.config))
+        except (OSError, ValueError):
+            worker.close()
+            return
+        with self._lock:
+            if self._closed:
+                worker.close()
+                return
+            self._workers.append(worker)
+        logger.info('worker {} connected with devices {}'.format(name, ', '.join(sorted(devices))),
+                    also_console=True)
+        Thread(name='remote_{}'.format(name), target=self._serve, args=(worker,), daemon=True).start()
+        self._dispatch()
+
+    def _serve(self, worker):
+        while True:
+            try:
+                message = worker.connection.recv()
+            except (OSError, EOFError):
+                break
+            if message[0] == 'event':
+                self.events.put(message[1])
+            elif message[0] == 'file':
+                self._write_file(message[1], message[2])
+            elif message[0] == 'result':
+                _, job_id, result = message
+                with self._lock:
+                    if job_id in worker.jobs:
+                        worker.jobs.remove(job_id)
+                    job = self._jobs.pop(job_id, None)
+                if job is not None:
+                    job['callback'](result)
+        self._lost(worker)
+
+    def _write_file(self, relative_path, data):
+        target = path.normpath(path.join(self.config['outputdir'], relative_path))
+        if path.isabs(relative_path) or path.relpath(target, self.config['outputdir']).startswith('..'):
+            logger.warn('ignoring output file {} outside of the outputdir'.format(relative_path))
+            return
+        makedirs(path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as output_file:
+            output_file.write(data)
+
+    def _lost(self, worker):
+        with self._lock:
+            if worker not in self._workers:
+                return
+            self._workers.remove(worker)
+            requeued, worker.jobs = worker.jobs, []
+            self._pending[:0] = requeued
+        worker.close()
+        if self._closed:
+            return
+        logger.warn('lost worker {}, requeuing its {} jobs'.format(worker.name, len(requeued)))
+        self._dispatch()
+
+    def _dispatch(self):
+        """
+        Sends every pending job to the worker owning its device
+        that currently runs the fewest jobs
+        """
+        sends = []
+        with self._lock:
+            for job_id in list(self._pending):
+                device = str(self._jobs[job_id]['suite'])
+                owners = [worker for worker in self._workers if device in worker.devices]
+                if not owners:
+                    if device not in self._waiting_for:
+                        self._waiting_for.add(device)
+                        logger.info('waiting for a worker with device {}'.format(device), also_console=True)
+                    continue
+                worker = min(owners, key=lambda owner: len(owner.jobs))
+                self._pending.remove(job_id)
+                worker.jobs.append(job_id)
+                sends.append((worker, job_id))
+        for worker, job_id in sends:
+            job = self._jobs[job_id]
+            try:
+                worker.send(('job', job_id, job['suite'].job, job['timeout']))
+            except (OSError, ValueError):
+                self._lost(worker)
+
+    def submit(self, suite, callback, error_callback, timeout=None):
+        if not suite.attempt:
+            suite.remove_rerun_outputs()
+        job_id = id(suite)
+        with self._lock:
+            self._jobs[job_id] = {
+                'suite': suite,
+                'callback': callback,
+                'timeout': timeout
+            }
+            self._pending.append(job_id)
+        self._dispatch()
+        return job_id
+
+    def _shutdown(self, message):
+        self._closed = True
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            try:
+                worker.send((message,))
+            except (OSError, ValueError):
+                pass
+            worker.close()
+        self._listener.close()
+
+    def terminate(self):
+        self._shutdown('stop')
+
+    def close(self):
+        self._shutdown('close')
+
+
+BACKENDS = {
+    'pool': PoolBackend,
+    'subprocess': SubprocessBackend,
+    'device': DeviceBackend,
+    'remote': RemoteBackend
+}
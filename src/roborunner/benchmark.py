@@ -0,0 +1,213 @@
+"""
+Measures the overhead of roborunner itself on a generated robot tree:
+
+    roborunner benchmark --files 50 --tests-per-file 20 --devices 4 --output benchmark.json
+
+Times the planning of jobs, the dispatch and progress overhead of the
+executor on top of the time spent in the tests, and the wall time and
+peak memory of writing each log tree. Options that are not benchmark
+options, e.g. --executor or --merge-processes, are passed on to the run.
+The results are written as json, so they can be compared across versions.
+"""
+from roborunner.config import Config
+from roborunner.device import BuildDeviceList
+from roborunner.executable_test_suite import BuildExecutableTestSuites
+from roborunner.test_suite_executor import TestSuiteExecutor
+from roborunner.log_tree import SuiteLogTree, DeviceLogTree
+
+from robot.api import logger
+from robot.version import VERSION as ROBOT_VERSION
+
+from multiprocessing import get_context
+from tempfile import mkdtemp
+from time import time
+from os import path, makedirs
+import argparse
+import platform
+import shutil
+import json
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    """
+    :return: the peak resident memory of this process in MB, or None where it is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def generate_tree(directory, files, tests_per_file, log_messages=0, sleep=0):
+    """
+    Writes `files` robot suites of `tests_per_file` tests each, which log
+    `log_messages` messages and then sleep or do nothing
+    """
+    makedirs(directory, exist_ok=True)
+    for file_index in range(files):
+        lines = ['*** Test Cases ***']
+        for test_index in range(tests_per_file):
+            lines.append('Test {} {}'.format(file_index, test_index))
+            for message_index in range(log_messages):
+                lines.append('    Log    message {} on ${{name}}'.format(message_index))
+            if sleep:
+                lines.append('    Sleep    {}'.format(sleep))
+            else:
+                lines.append('    No Operation')
+        with open(path.join(directory, 'suite_{:04d}.robot'.format(file_index)), 'w') as suite_file:
+            suite_file.write('\n'.join(lines) + '\n')
+
+
+def generate_devices(devices_file, devices, slots=1):
+    with open(devices_file, 'w') as json_file:
+        json_file.write(json.dumps({
+            'devices': [{'name': 'device_{}'.format(index), 'slots': slots} for index in range(devices)]
+        }, indent=4))
+
+
+def _measure_idle(queue):
+    queue.put({'peak_rss_mb': peak_rss_mb()})
+
+
+def _measure_log_tree(tree_class, executables, config, queue):
+    started = time()
+    tree = tree_class(executables, name=config['top_level_name'], config=config)
+    tree.results.load()
+    loaded = time()
+    tree.write()
+    finished = time()
+    queue.put({
+        'wall_seconds': finished - started,
+        'parse_seconds': loaded - started,
+        'write_seconds': finished - loaded,
+        'peak_rss_mb': peak_rss_mb()
+    })
+
+
+def _in_fresh_process(target, *args):
+    """
+    Runs target in a newly spawned interpreter, so the peak memory
+    it reports belongs to that measurement alone
+    """
+    context = get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=args + (queue,))
+    process.start()
+    measurement = queue.get()
+    process.join()
+    return measurement
+
+
+def measure_planning(config, devices):
+    started = time()
+    executables = BuildExecutableTestSuites(devices=devices, config=config).build()
+    cold = time() - started
+    started = time()
+    BuildExecutableTestSuites(devices=devices, config=config).build()
+    warm = time() - started
+    return executables, {
+        'jobs': len(executables),
+        'cold_seconds': cold,
+        'warm_seconds': warm
+    }
+
+
+def measure_execution(config, executables, devices):
+    """
+    The overhead is the wall time beyond the shortest possible run of the same
+    jobs, which is bound by the longest job and by the jobs spread evenly over
+    all workers
+    """
+    started = time()
+    summary = TestSuiteExecutor(executables, config=config).run()
+    wall = time() - started
+    elapsed = [job['elapsed'] for job in summary['jobs']]
+    workers = min(config['max_processes'], sum(device.slots for device in devices))
+    ideal = max([sum(elapsed) / workers] + elapsed) if elapsed else 0.0
+    return {
+        'wall_seconds': wall,
+        'jobs_elapsed_seconds': sum(elapsed),
+        'workers': workers,
+        'overhead_seconds': max(0.0, wall - ideal),
+        'overhead_per_job_seconds': max(0.0, wall - ideal) / max(1, len(elapsed)),
+        'tests': summary.test_count
+    }
+
+
+def run_benchmark(args):
+    parser = argparse.ArgumentParser(
+        prog='roborunner benchmark',
+        description='Measure the overhead of roborunner on a generated robot tree'
+    )
+    parser.add_argument('--files', type=int, dest='files', default=20,
+                        help='Number of generated suite files. Defaults to 20')
+    parser.add_argument('--tests-per-file', type=int, dest='tests_per_file', default=10,
+                        help='Number of tests in every suite. Defaults to 10')
+    parser.add_argument('--devices', type=int, dest='devices', default=2,
+                        help='Number of generated devices. Defaults to 2')
+    parser.add_argument('--slots', type=int, dest='slots', default=1,
+                        help='Concurrent jobs per generated device. Defaults to 1')
+    parser.add_argument('--log-messages', type=int, dest='log_messages', default=0,
+                        help='Log keywords per test, to scale the size of the outputs. Defaults to 0')
+    parser.add_argument('--sleep', type=float, dest='sleep', default=0,
+                        help='Seconds every test sleeps, 0 runs No Operation instead. Defaults to 0')
+    parser.add_argument('--workdir', type=str, dest='workdir', default=None,
+                        help='Directory for the generated tree and the outputs, \
+                            defaults to a temporary directory which is removed afterwards')
+    parser.add_argument('--output', type=str, dest='output', default=None,
+                        help='Write the json results to this file instead of the console')
+    scale, run_args = parser.parse_known_args(args)
+
+    workdir = scale.workdir or mkdtemp(prefix='roborunner_benchmark_')
+    try:
+        tree = path.join(workdir, 'tests')
+        devices_file = path.join(workdir, 'devices.json')
+        generate_tree(tree, scale.files, scale.tests_per_file, scale.log_messages, scale.sleep)
+        generate_devices(devices_file, scale.devices, scale.slots)
+        config = Config.parse_args(
+            run_args + ['--devices', devices_file, '--outputdir', path.join(workdir, 'results'), tree]
+        )
+        devices = BuildDeviceList(config=config).build()
+
+        executables, planning = measure_planning(config, devices)
+        execution = measure_execution(config, executables, devices)
+        log_trees = {
+            'baseline_rss_mb': _in_fresh_process(_measure_idle)['peak_rss_mb'],
+            'suite_log_tree': _in_fresh_process(_measure_log_tree, SuiteLogTree, executables, config),
+            'device_log_tree': _in_fresh_process(_measure_log_tree, DeviceLogTree, executables, config)
+        }
+    finally:
+        if not scale.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = json.dumps({
+        'python': platform.python_version(),
+        'robotframework': ROBOT_VERSION,
+        'scale': {
+            'files': scale.files,
+            'tests_per_file': scale.tests_per_file,
+            'devices': scale.devices,
+            'slots': scale.slots,
+            'log_messages': scale.log_messages,
+            'sleep': scale.sleep,
+            'executor': config['executor'],
+            'max_processes': config['max_processes']
+        },
+        'planning': planning,
+        'execution': execution,
+        'log_trees': log_trees
+    }, indent=4, sort_keys=True)
+    if scale.output:
+        with open(scale.output, 'w') as output_file:
+            output_file.write(results)
+        logger.info('benchmark results written to {}'.format(scale.output), also_console=True)
+    else:
+        print(results)
@@ -0,0 +1,113 @@
+from roborunner.parse_cache import ParseCache, import_path
+
+from robot.api import logger
+from robot.errors import DataError
+from robot.running.builder import ResourceFileBuilder
+
+from os import path, makedirs
+from hashlib import sha1
+import json
+
+
+class ChangeTracker:
+    """
+    Remembers a content hash of the inputs of every job that passed: the
+    suite files, the resource, variable and library files they import, the
+    device variables and the active test filters. With --changed-only only
+    the jobs whose hash differs from their last passing run are executed,
+    the outputs of the other jobs are reused for the log trees.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.path = path.join(config['outputdir'], '.roborunner_changes.json')
+        self._digests = {}
+        self._files = {}
+        self._file_hashes = {}
+        if path.exists(self.path):
+            try:
+                with open(self.path, 'r') as changes_file:
+                    self._digests = json.loads(changes_file.read())
+            except (OSError, ValueError) as e:
+                logger.info('could not read changes file {}: {}'.format(self.path, e))
+
+    @staticmethod
+    def key(suite):
+        return path.join(suite.test_name, suite.output)
+
+    def files(self, source):
+        """
+        :return: the files of a suite and every file it imports, following
+            imports of resource files
+        """
+        if source in self._files:
+            return self._files[source]
+        files = set()
+        pending = list(ParseCache(self.config).files(source))
+        while pending:
+            file_path = pending.pop()
+            if file_path in files:
+                continue
+            files.add(file_path)
+            if file_path == path.abspath(source) or file_path.endswith('.py'):
+                continue
+            try:
+                resource = ResourceFileBuilder().build(file_path)
+            except DataError:
+                continue
+            for item in resource.imports:
+                imported = import_path(item)
+                if imported is not None:
+                    pending.append(imported)
+        self._files[source] = sorted(files)
+        return self._files[source]
+
+    def _file_hash(self, file_path):
+        if file_path not in self._file_hashes:
+            try:
+                with open(file_path, 'rb') as input_file:
+                    self._file_hashes[file_path] = sha1(input_file.read()).hexdigest()
+            except OSError:
+                self._file_hashes[file_path] = None
+        return self._file_hashes[file_path]
+
+    def digest(self, suite):
+        inputs = [
+            self.config['debug_testcase'],
+            self.config['include_tags'],
+            suite.tests,
+            suite.variables
+        ]
+        inputs.extend((file_path, self._file_hash(file_path)) for file_path in self.files(suite.source))
+        return sha1(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+    def changed(self, suites):
+        """
+        :return: the suites whose inputs changed since they last passed,
+            or whose output is missing
+        """
+        changed = []
+        for suite in suites:
+            if self._digests.get(self.key(suite)) != self.digest(suite) or not path.exists(suite.result_path):
+                changed.append(suite)
+        return changed
+
+    def record(self, suites, summary):
+        """
+        Remembers the inputs of the suites whose tests all passed in the end,
+        reruns included, and forgets those of the others
+
+        :param summary: the RunSummary of the run
+        """
+        final_tests = summary.final_tests
+        for suite in suites:
+            tests = [final_tests.get((suite.result_key, name)) for name in suite.selected_tests]
+            if tests and all(test is not None and test.passed for test in tests):
+                self._digests[self.key(suite)] = self.digest(suite)
+            else:
+                self._digests.pop(self.key(suite), None)
+
+    def save(self):
+        makedirs(path.dirname(path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'w') as changes_file:
+            changes_file.write(json.dumps(self._digests, indent=4, sort_keys=True))
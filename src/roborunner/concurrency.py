@@ -0,0 +1,117 @@
+from robot.api import logger
+
+from time import time
+from os import cpu_count
+import os
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# load average per cpu above which fewer jobs run at once, and below which more may run
+LOAD_HIGH = 1.25
+LOAD_LOW = 0.75
+# share of the memory of the machine that is kept available
+MEMORY_RESERVE = 0.1
+
+
+def cpu_load():
+    """
+    :return: the load average of the last minute per cpu, or None where it is not available
+    """
+    try:
+        if psutil is not None:
+            load = psutil.getloadavg()[0]
+        else:
+            load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+    return load / (cpu_count() or 1)
+
+
+def memory():
+    """
+    :return: the total and the available memory in bytes, or (None, None) where it is not available
+    """
+    if psutil is not None:
+        virtual_memory = psutil.virtual_memory()
+        return virtual_memory.total, virtual_memory.available
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            values = dict(line.split(':', 1) for line in meminfo)
+        return (
+            int(values['MemTotal'].split()[0]) * 1024,
+            int(values['MemAvailable'].split()[0]) * 1024
+        )
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class ConcurrencyController:
+    """
+    Decides how many jobs run at once with --adaptive-concurrency. Starts at one
+    job per cpu within the bounds, then every --adaptive-interval seconds runs
+    one job more while every slot is busy and the machine has cpu and memory to
+    spare, and fewer when the load average gets too high or the available memory
+    drops below the reserve. The memory of a job is estimated from how much
+    the available memory dropped since no job was running, so it includes the
+    browsers and emulators the job started.
+    """
+
+    def __init__(self, minimum, maximum, interval):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.interval = interval
+        self.limit = min(self.maximum, max(self.minimum, cpu_count() or 1))
+        self._idle_available = memory()[1]
+        self._changed = time()
+        logger.info('adaptive concurrency starts at {} jobs, between {} and {}'.format(
+            self.limit, self.minimum, self.maximum
+        ), also_console=True)
+
+    def _job_memory(self, running, available):
+        if not running or self._idle_available is None or available is None:
+            return None
+        return max(0, self._idle_available - available) / running
+
+    def update(self, running, pending):
+        """
+        :param running: number of jobs running right now
+        :param pending: number of jobs waiting for a slot
+        :return: the number of jobs that may run at once
+        """
+        if time() - self._changed < self.interval:
+            return self.limit
+        load = cpu_load()
+        total, available = memory()
+        if not running and available is not None:
+            self._idle_available = available
+        job_memory = self._job_memory(running, available)
+        reserve = total * MEMORY_RESERVE if total else None
+        limit = self.limit
+        reason = None
+        if reserve is not None and available < reserve:
+            limit = self.limit - 1
+            if job_memory:
+                limit = min(limit, running - int((reserve - available) // job_memory) - 1)
+            reason = 'available memory below the reserve of {:.0f} MB'.format(reserve / 1048576)
+        elif load is not None and load > LOAD_HIGH:
+            limit = self.limit - 1
+            reason = 'load above {} per cpu'.format(LOAD_HIGH)
+        elif running >= self.limit and pending and (load is None or load < LOAD_LOW):
+            fits = reserve is None or not job_memory or available - job_memory > reserve
+            if fits:
+                limit = self.limit + 1
+                reason = 'every slot busy, load and memory to spare'
+        limit = min(self.maximum, max(self.minimum, limit))
+        if limit != self.limit:
+            logger.info('concurrency {} -> {}: {} (load {} per cpu, {} MB available, ~{} MB per job)'.format(
+                self.limit, limit, reason,
+                '{:.2f}'.format(load) if load is not None else 'unknown',
+                '{:.0f}'.format(available / 1048576) if available is not None else 'unknown',
+                '{:.0f}'.format(job_memory / 1048576) if job_memory is not None else 'unknown'
+            ), also_console=True)
+            self.limit = limit
+            self._changed = time()
+        return self.limit
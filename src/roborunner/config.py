@@ -1,21 +1,35 @@
 import argparse
-from robot.api import logger
 
-from os import cpu_count
+from os import cpu_count, environ
+
+# the config of the run in the current process, set in every process that
+# runs jobs, so the jobs sent to it do not each carry a copy of it
+_process_config = None
+
+
+def set_process_config(config):
+    global _process_config
+    _process_config = config
+
+
+def process_config():
+    return _process_config
 
 
 class Config(dict):
 
-    @staticmethod
-    def parse_args(args):
-        """
-        Allows us to parse arguments.
-        Use --help to see a full list of options
+    # the argument parser and the parsed defaults, built once per process
+    _parser = None
+    _defaults = {}
 
-        :param args:
-        :return: Config object with parsed out arguments (or default values)
-        """
-        parser = argparse.ArgumentParser(description='Set configuration for run.py')
+    @staticmethod
+    def _build_parser():
+        parser = argparse.ArgumentParser(
+            description='Set configuration for run.py',
+            # run.py dispatches the subcommands before the options are parsed
+            epilog='subcommands: worker, benchmark, history; run `roborunner <subcommand> --help` \
+                for their options'
+        )
         parser.add_argument(
             '--loglevel',
             help='set the loglevel accoring to RF\'s log config',
@@ -30,6 +44,29 @@ class Config(dict):
                 defaults to 4 or twice your cpu count. Whichever is higher.',
             default=max(4, cpu_count() * 2)
         )
+        parser.add_argument(
+            '--adaptive-concurrency',
+            action='store_true',
+            dest='adaptive_concurrency',
+            help='Adapt the number of jobs running at once to the cpu load and the available \
+                memory, between --min-processes and --max-processes',
+            default=False
+        )
+        parser.add_argument(
+            '--min-processes',
+            type=int,
+            dest='min_processes',
+            help='Fewest jobs running at once with --adaptive-concurrency. Defaults to 1',
+            default=1
+        )
+        parser.add_argument(
+            '--adaptive-interval',
+            type=float,
+            dest='adaptive_interval',
+            help='Seconds between changes of the number of jobs running at once with \
+                --adaptive-concurrency. Defaults to 5',
+            default=5
+        )
         parser.add_argument(
             '--local',
             action='store_true',
@@ -67,6 +104,24 @@ class Config(dict):
             help='set the json file containing a list of devices',
             default='devices.json'
         )
+        parser.add_argument(
+            '--coverage',
+            type=str,
+            choices=['full', 'pairwise', 'n-wise'],
+            dest='coverage',
+            help='Which combinations of the parameter matrix in the devices file run: every \
+                combination, every pair of values, or every combination of --coverage-strength \
+                axes. Defaults to the coverage of the matrix, or pairwise',
+            default=None
+        )
+        parser.add_argument(
+            '--coverage-strength',
+            type=int,
+            dest='coverage_strength',
+            help='Number of axes whose combinations are all covered with --coverage n-wise. \
+                Defaults to the strength of the matrix, or 3',
+            default=None
+        )
         parser.add_argument(
             '--rerun-failed',
             action='store_true',
@@ -74,12 +129,254 @@ class Config(dict):
             help='Set whether to rerun test suites with failed test cases. Defaults to True',
             default=False
         )
+        parser.add_argument(
+            '--rerun-mode',
+            type=str,
+            choices=['suite', 'failed'],
+            dest='rerun_mode',
+            help='With --rerun-failed, either rerun the whole suite when more than half of it \
+                failed, or rerun only the failed tests and merge them into the first result. \
+                Defaults to suite',
+            default='suite'
+        )
+        parser.add_argument(
+            '--rerun-attempts',
+            type=int,
+            dest='rerun_attempts',
+            help='How many times failed tests are rerun with --rerun-mode failed. Defaults to 1',
+            default=1
+        )
+        parser.add_argument(
+            '--rerun-on-other-device',
+            action='store_true',
+            dest='rerun_on_other_device',
+            help='Rerun failed tests on another device with a free slot when there is one',
+            default=False
+        )
+        parser.add_argument(
+            '--executor',
+            type=str,
+            choices=['pool', 'subprocess', 'device', 'remote'],
+            help='Run jobs in a multiprocessing pool, each in its own python process, \
+                on long-lived processes pinned to each device, which run its suites one \
+                after another and support --session-hook, or on `roborunner worker` \
+                processes that connect to --listen. Every executor but pool supports \
+                --job-timeout. Defaults to pool',
+            default='pool'
+        )
+        parser.add_argument(
+            '--session-hook',
+            type=str,
+            dest='session_hook',
+            help='Python file or module with open_session(device), and optionally \
+                session_alive(device, session) and close_session(device, session), \
+                whose session suites can reuse with --executor device',
+            default=None
+        )
+        parser.add_argument(
+            '--listen',
+            type=str,
+            dest='listen',
+            help='host:port on which the remote executor waits for workers. Use 0.0.0.0:<port> \
+                to accept workers from other hosts. Defaults to 127.0.0.1:8271',
+            default='127.0.0.1:8271'
+        )
+        parser.add_argument(
+            '--coordinator',
+            type=str,
+            dest='coordinator',
+            help='host:port of the coordinator a `roborunner worker` takes its jobs from. \
+                Defaults to localhost:8271',
+            default='localhost:8271'
+        )
+        parser.add_argument(
+            '--authkey',
+            type=str,
+            dest='authkey',
+            help='Shared secret of the coordinator and its workers, which exchange pickled jobs. \
+                Defaults to $ROBORUNNER_AUTHKEY, one of them is required by the remote executor \
+                and by `roborunner worker`',
+            default=environ.get('ROBORUNNER_AUTHKEY')
+        )
+        parser.add_argument(
+            '--job-timeout',
+            type=float,
+            dest='job_timeout',
+            help='Stop a job that runs longer than this many seconds and fail its tests. \
+                Supported by every executor except pool',
+            default=None
+        )
+        parser.add_argument(
+            '--deadline',
+            type=float,
+            help='Stop the whole run after this many seconds, failing the tests of \
+                all jobs that did not finish',
+            default=None
+        )
+        parser.add_argument(
+            '--breaker-threshold',
+            type=int,
+            dest='breaker_threshold',
+            help='Take a device out of rotation after this many jobs in a row in which \
+                every test failed. Defaults to 0 (never)',
+            default=0
+        )
+        parser.add_argument(
+            '--reroute-jobs',
+            action='store_true',
+            dest='reroute_jobs',
+            help='Move the pending jobs of a device taken out of rotation to the other devices \
+                instead of failing them',
+            default=False
+        )
+        parser.add_argument(
+            '--preflight',
+            type=str,
+            help='Command run for every device before the run starts, e.g. \
+                "adb -s {udid} shell true". Devices where it fails are taken out of rotation',
+            default=None
+        )
+        parser.add_argument(
+            '--preflight-timeout',
+            type=float,
+            dest='preflight_timeout',
+            help='Seconds a pre-flight command may take. Defaults to 60',
+            default=60
+        )
+        parser.add_argument(
+            '--max-message-length',
+            type=int,
+            dest='max_message_length',
+            help='Truncate failure messages in job results to this many characters. Defaults to 200',
+            default=200
+        )
         parser.add_argument(
             '--outputdir',
             type=str,
             help='directory to output test results',
             default='results'
         )
+        parser.add_argument(
+            '--split',
+            type=int,
+            dest='split_tests',
+            help='Split every suite into jobs of at most this many test cases. \
+                Use 1 to run each test case as its own job. Defaults to 0 (no splitting)',
+            default=0
+        )
+        parser.add_argument(
+            '--schedule',
+            type=str,
+            choices=['longest-first', 'listed'],
+            help='Order in which suites are started. longest-first uses the timings \
+                of earlier runs to start the slowest suites first. Defaults to longest-first',
+            default='longest-first'
+        )
+        parser.add_argument(
+            '--timings-file',
+            type=str,
+            dest='timings_file',
+            help='json file with suite timings of earlier runs, \
+                defaults to .roborunner_timings.json in the outputdir',
+            default=None
+        )
+        parser.add_argument(
+            '--history-file',
+            type=str,
+            dest='history_file',
+            help='SQLite file the results of every run are added to, queried with \
+                `roborunner history`. Defaults to .roborunner_history.sqlite in the outputdir',
+            default=None
+        )
+        parser.add_argument(
+            '--merge-processes',
+            type=int,
+            dest='merge_processes',
+            help='number of processes used to write the combined logs, and the logs of the jobs \
+                with --merge-mode streaming. Defaults to 1',
+            default=1
+        )
+        parser.add_argument(
+            '--merge-mode',
+            type=str,
+            dest='merge_mode',
+            choices=['memory', 'streaming'],
+            help='Combine the worker outputs in memory, or write the log of every job next to \
+                its output and stream the jobs into the combined xml one at a time, which keeps \
+                memory bounded by the largest job. The combined logs are then written without \
+                keywords and link to the log of every job. Defaults to memory',
+            default='memory'
+        )
+        parser.add_argument(
+            '--remove-keywords',
+            type=str,
+            action='append',
+            dest='remove_keywords',
+            help='Remove keywords from the output of every job before it is stored, like \
+                robot\'s --removekeywords: all, passed, for, wuks or name:<pattern>. \
+                Can be given more than once',
+            default=None
+        )
+        parser.add_argument(
+            '--compress-outputs',
+            action='store_true',
+            dest='compress_outputs',
+            help='Store the output of every job gzip compressed',
+            default=False
+        )
+        parser.add_argument(
+            '--parse-cache',
+            action='store_true',
+            dest='parse_cache',
+            help='Keep parsed suite names and test lists in the outputdir between runs',
+            default=False
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            help='Continue a run that was interrupted: jobs that finished according to the \
+                journal in the outputdir are not run again',
+            default=False
+        )
+        parser.add_argument(
+            '--changed-only',
+            action='store_true',
+            dest='changed_only',
+            help='Only run the jobs whose suite, imported files, device or filters changed \
+                since they last passed, and reuse the outputs of the other jobs',
+            default=False
+        )
+        parser.add_argument(
+            '--watch',
+            action='store_true',
+            dest='watch',
+            help='Keep running: wait for changes to the test files and their imports, \
+                then run the changed jobs like --changed-only',
+            default=False
+        )
+        parser.add_argument(
+            '--watch-interval',
+            type=float,
+            dest='watch_interval',
+            help='Seconds between checks for changed files in --watch mode. Defaults to 1',
+            default=1.0
+        )
+        parser.add_argument(
+            '--trace',
+            type=str,
+            dest='trace',
+            help='Write the phases of the run and the spans of every job to this file as a \
+                Chrome trace (chrome://tracing), with a text summary next to it',
+            default=None
+        )
+        parser.add_argument(
+            '--events-file',
+            type=str,
+            dest='events_file',
+            help='Append the start and end of every suite and test as json lines to this file',
+            default=None
+        )
         parser.add_argument(
             '--include',
             dest='include_tags',
@@ -87,19 +384,44 @@ class Config(dict):
             help='only run these tests with this tag. Accepts * and ? as well.',
             default=None
         )
+        parser.add_argument(
+            '--dry-plan',
+            action='store_true',
+            dest='dry_plan',
+            help='Print which suites would run on which devices and exit without running them',
+            default=False
+        )
         parser.add_argument(
             'test_file_paths',
             nargs='*',
             default=['tests/'],
             help='Specify the test files which will be run'
         )
+        return parser
+
+    @staticmethod
+    def parse_args(args):
+        """
+        Allows us to parse arguments.
+        Use --help to see a full list of options
+
+        :param args:
+        :return: Config object with parsed out arguments (or default values)
+        """
+        if Config._parser is None:
+            Config._parser = Config._build_parser()
         try:
-            parsed_args = parser.parse_args(args)
-            dict_args = vars(parsed_args)
+            parsed_args = Config._parser.parse_args(args)
+            # the parser hands out the same default lists on every call
+            dict_args = {
+                key: list(value) if isinstance(value, list) else value
+                for key, value in vars(parsed_args).items()
+            }
             if dict_args['local_device']:
                 dict_args['max_processes'] = 1
             return dict_args
         except Exception as e:
+            from robot.api import logger
             logger.error(str(e))
             raise e
 
@@ -108,5 +430,10 @@ class Config(dict):
 
         :param kwargs: a set of options which the config object will copy into itself
         """
-        self.update(Config.parse_args(args))
+        if args not in Config._defaults:
+            Config._defaults[args] = Config.parse_args(args)
+        self.update({
+            key: list(value) if isinstance(value, list) else value
+            for key, value in Config._defaults[args].items()
+        })
         super().__init__(**kwargs)
@@ -2,10 +2,12 @@ from roborunner.config import Config
 import json
 
 class Device(dict):
-    def __init__(self, name, local_device=False, **kwargs):
+    def __init__(self, name, local_device=False, slots=1, **kwargs):
         """
         Acts like a dictionary for a single device. Would be easy to
         add or remove features to make this compatible with desktop
+
+        :param slots: how many suites may run on this device at the same time
         """
         super().__init__()
         super().update(kwargs)
@@ -13,6 +15,8 @@ class Device(dict):
             'name': name, 
             'local_device': local_device
         })
+        # only the scheduler uses slots, the fields of the dict become robot variables
+        self.slots = slots
 
     def __str__(self):
         return self['name']
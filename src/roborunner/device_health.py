@@ -0,0 +1,83 @@
+from robot.api import logger
+
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run as run_command, TimeoutExpired, DEVNULL
+import shlex
+
+
+class DeviceHealth:
+    """
+    Circuit breaker for devices. Counts the jobs in a row in which every
+    test failed on a device, and takes the device out of rotation once
+    that count reaches the threshold. A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, threshold=0):
+        self.threshold = threshold
+        self._failures = {}
+        self.tripped = {}
+
+    def is_tripped(self, device):
+        return str(device) in self.tripped
+
+    def trip(self, device, reason):
+        """
+        :return: True if the device was not out of rotation before
+        """
+        device = str(device)
+        if device in self.tripped:
+            return False
+        self.tripped[device] = reason
+        logger.warn('taking device {} out of rotation: {}'.format(device, reason))
+        return True
+
+    def record(self, suite, result):
+        """
+        Records the outcome of a finished job
+
+        :param result: the JobResult of the job
+        :return: True if this outcome tripped the breaker of its device
+        """
+        if not self.threshold:
+            return False
+        device = str(suite)
+        if result.test_count and result.failed == result.test_count:
+            self._failures[device] = self._failures.get(device, 0) + 1
+        else:
+            self._failures[device] = 0
+        if self._failures[device] >= self.threshold:
+            return self.trip(
+                device,
+                'every test failed in {} jobs in a row'.format(self._failures[device])
+            )
+        return False
+
+    def preflight(self, devices, command, timeout=None):
+        """
+        Runs the pre-flight command for all devices in parallel and trips the
+        devices where it fails. Fields of the device can be used in the
+        command, e.g. `adb -s {udid} shell true`.
+        """
+        def check(device):
+            try:
+                completed = run_command(
+                    shlex.split(command.format(**device)),
+                    stdout=DEVNULL,
+                    stderr=DEVNULL,
+                    timeout=timeout
+                )
+                return completed.returncode, None
+            except TimeoutExpired:
+                return None, 'pre-flight check timed out after {} seconds'.format(timeout)
+            except (OSError, KeyError, ValueError) as e:
+                return None, 'pre-flight check could not run: {}'.format(e)
+
+        if not devices:
+            return
+        with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+            outcomes = executor.map(check, devices)
+            for device, (return_code, error) in zip(devices, outcomes):
+                if error:
+                    self.trip(device, error)
+                elif return_code:
+                    self.trip(device, 'pre-flight check exited with code {}'.format(return_code))
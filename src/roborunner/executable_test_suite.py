@@ -1,30 +1,222 @@
-from roborunner.config import Config
+from roborunner.config import Config, process_config
 from roborunner.device import Device, BuildDeviceList
+from roborunner.matrix import BuildParameterMatrix
+from roborunner.parse_cache import ParseCache
+from roborunner.progress import ProgressListener
+from roborunner.job_result import JobResult
+from roborunner.tracing import span
 
-from robot.api import TestCaseFile, TestSuiteBuilder, logger
+from robot.api import TestSuiteBuilder, ExecutionResult, logger
 from robot.running import TestSuite
+from robot.result.executionresult import Result
+from robot.utils import get_timestamp
+
+from os import path, makedirs, remove, walk
+from glob import glob, escape as glob_escape
+from collections import namedtuple
+from time import time
+import shutil
+import gzip
+import re
+
+# matches the outputs of reruns, compressed or not, and captures the attempt
+RERUN_OUTPUT = re.compile(r'\.rerun-(\d+)\.xml(\.gz)?$')
+# characters replaced in output paths, which are named after the device and parameters of a job
+UNSAFE_PATH_CHARACTERS = re.compile(r'[^\w .-]+')
+
+# what a process needs to know to run a job, sent instead of the whole
+# ExecutableTestSuite. The config is left out, every process that runs
+# jobs has the config of the run (see roborunner.config.process_config).
+Job = namedtuple('Job', ['source', 'test_name', 'tests', 'shard', 'attempt', 'suite_name', 'parameters', 'device'])
+
+
+def _select_tests(suite, names, prefix=''):
+    """
+    Removes every test whose relative name is not in names,
+    along with the child suites left empty.
+    """
+    suite.tests = [test for test in suite.tests if prefix + test.name in names]
+    for child in suite.suites:
+        _select_tests(child, names, prefix + child.name + '.')
+    suite.suites = [child for child in suite.suites if child.test_count]
 
-from os import path, makedirs, listdir
 
 class ExecutableTestSuite(Device):
 
-    def __init__(self, source, config=None, **kwargs):
+    def __init__(self, source, config=None, tests=None, shard=None, attempt=0, suite_name=None,
+                 parameters=None, test_name=None, **kwargs):
+        """
+
+        :param source: path of the suite to run
+        :param config:
+        :param tests: optional list of relative test names, runs only these tests
+        :param shard: index of this chunk when a suite is split across several jobs
+        :param attempt: 0 for the first run, n for the n-th rerun of failed tests
+        :param suite_name: name of the result suite, defaults to the device name and
+            the parameters. Reruns on another device keep the name of the original device
+        :param parameters: values of the axes of the parameter matrix, passed to robot
+            as variables next to those of the device
+        :param test_name: name of the suite, parsed from the source if not given
+        :param kwargs: the device this suite runs on
+        """
         if config is None:
             config = {}
         self._test_count = None
         self.source = source
-        self.test_name = TestCaseFile(source=self.source).name
+        self.tests = tests
+        self.shard = shard
+        self.attempt = attempt
+        self.suite_name = suite_name
+        self.parameters = parameters or {}
         self.config = config
         if not self.config:
             self.config = Config()
+        self.test_name = test_name or ParseCache(self.config).name(self.source)
         super().__init__(**kwargs)
 
+    @property
+    def job(self):
+        return Job(
+            source=self.source,
+            test_name=self.test_name,
+            tests=tuple(self.tests) if self.tests is not None else None,
+            shard=self.shard,
+            attempt=self.attempt,
+            suite_name=self.suite_name,
+            parameters=tuple(self.parameters.items()),
+            device=tuple(self.items())
+        )
+
+    @classmethod
+    def from_job(cls, job, config):
+        return cls(
+            source=job.source,
+            config=config,
+            tests=list(job.tests) if job.tests is not None else None,
+            shard=job.shard,
+            attempt=job.attempt,
+            suite_name=job.suite_name,
+            parameters=dict(job.parameters),
+            test_name=job.test_name,
+            **dict(job.device)
+        )
+
     def __str__(self):
         return super().__str__()
 
+    @property
+    def device_label(self):
+        """
+        the device name, followed by the parameters of the matrix this suite runs with
+        """
+        if not self.parameters:
+            return str(self)
+        return '{} [{}]'.format(str(self), ', '.join(
+            '{}={}'.format(name, value) for name, value in self.parameters.items()
+        ))
+
+    @property
+    def result_name(self):
+        return self.suite_name or self.device_label
+
+    @property
+    def display_name(self):
+        display_name = self.test_name
+        if self.shard is not None:
+            display_name += ' [shard {}]'.format(self.shard)
+        if self.attempt:
+            display_name += ' [rerun {}]'.format(self.attempt)
+        return display_name
+
+    @property
+    def result_key(self):
+        """
+        identifies the results of this suite and device, shared by all its shards and reruns
+        """
+        return '{} on {}'.format(self.test_name, self.result_name)
+
+    @property
+    def job_key(self):
+        """
+        identifies this job across runs, shared by all its reruns
+        """
+        return path.join(self.test_name, self._output_base)
+
+    @property
+    def job_name(self):
+        return '{} on {}'.format(self.display_name, self.device_label)
+
+    @property
+    def output_name(self):
+        """
+        the result name as it is used in output paths, `dev [os=13, locale=en_US]`
+        becomes `dev os-13 locale-en_US` and characters that are not safe in a
+        file name, like path separators, are replaced with _
+        """
+        name = self.result_name.translate(str.maketrans({'=': '-', ',': None, '[': None, ']': None}))
+        return UNSAFE_PATH_CHARACTERS.sub('_', name).strip(' .') or '_'
+
+    @property
+    def _output_base(self):
+        if self.shard is None:
+            return self.output_name
+        return path.join(self.output_name, 'shard-{}'.format(self.shard))
+
     @property
     def output(self):
-        return str(self) + '.xml'
+        if self.attempt:
+            return '{}.rerun-{}.xml'.format(self._output_base, self.attempt)
+        return self._output_base + '.xml'
+
+    @property
+    def result_path(self):
+        """
+        path of the stored output, which is gzip compressed with --compress-outputs
+        """
+        result_path = path.join(self.outputdir, self.output)
+        if self.config.get('compress_outputs'):
+            result_path += '.gz'
+        return result_path
+
+    def _find_rerun_outputs(self):
+        pattern = path.join(self.outputdir, glob_escape(self._output_base) + '.rerun-*.xml*')
+        return [rerun for rerun in glob(pattern) if RERUN_OUTPUT.search(rerun)]
+
+    @property
+    def rerun_outputs(self):
+        """
+        :return: paths of the outputs of all reruns of this suite, in the order they ran
+        """
+        compressed = bool(self.config.get('compress_outputs'))
+        reruns = [
+            rerun for rerun in self._find_rerun_outputs()
+            if bool(RERUN_OUTPUT.search(rerun).group(2)) == compressed
+        ]
+        return sorted(reruns, key=lambda rerun: int(RERUN_OUTPUT.search(rerun).group(1)))
+
+    def remove_rerun_outputs(self):
+        """
+        Removes the rerun outputs of an earlier run, so they are
+        not merged into the results of a new first attempt
+        """
+        for stale_rerun in self._find_rerun_outputs():
+            remove(stale_rerun)
+
+    def _store_output(self, remove_keywords=True):
+        """
+        Removes keywords from the output robot wrote as --remove-keywords
+        asks for, and compresses it with --compress-outputs
+        """
+        xml_path = path.join(self.outputdir, self.output)
+        if remove_keywords and self.config.get('remove_keywords'):
+            result = ExecutionResult(xml_path)
+            for how in self.config['remove_keywords']:
+                result.suite.remove_keywords(how)
+            result.save(xml_path)
+        if self.config.get('compress_outputs'):
+            with open(xml_path, 'rb') as xml_file, gzip.open(xml_path + '.gz', 'wb', compresslevel=6) as gzip_file:
+                shutil.copyfileobj(xml_file, gzip_file)
+            remove(xml_path)
 
     @property
     def outputdir(self):
@@ -32,61 +224,188 @@ class ExecutableTestSuite(Device):
     
     @property
     def test_count(self):
-        if self._test_count:
+        if self._test_count is not None:
             return self._test_count
-        suite = TestSuiteBuilder().build(self.source)
-        suite.filter(
-            included_tests=self.config['debug_testcase'], 
-            included_tags=[self.config['include_tags']]
-        )
-        self._test_count = suite.test_count
+        if self.tests is not None:
+            self._test_count = len(self.tests)
+        else:
+            self._test_count = len(ParseCache(self.config).tests(self.source))
         return self._test_count
 
     @property
     def variables(self):
         _variables = super().copy()
+        _variables.update(self.parameters)
         _variables['name'] = str(self)
         return ['{}:{}'.format(key, value) for key, value in _variables.items()]
 
-    def run(self, verbose=False):
-        makedirs(self.outputdir, exist_ok=True)
-        stdout = open('{}.out'.format(self.outputdir + '/' + str(self)), 'w')
-        stderr = open('{}.err'.format(self.outputdir + '/' + str(self)), 'w')
-        suite = TestSuiteBuilder().build(self.source)
-        suite.name = str(self)
-        suite.filter(
-            included_tests=self.config['debug_testcase'], 
-            included_tags=[self.config['include_tags']]
+    def run(self, verbose=False, events=None):
+        """
+
+        :param verbose: write robot's console output to the console instead of .out/.err files
+        :param events: optional queue which receives the start and end of every suite and test
+        :return: a JobResult summarizing the run
+        """
+        spans = []
+        started = time()
+        output_base = path.splitext(path.join(self.outputdir, self.output))[0]
+        makedirs(path.dirname(output_base), exist_ok=True)
+        if not self.attempt:
+            self.remove_rerun_outputs()
+        with span(spans, 'parse'):
+            suite = TestSuiteBuilder().build(self.source)
+            suite.name = self.result_name
+            if self.result_name != self.device_label:
+                suite.metadata['Executed on'] = str(self)
+            for name, value in self.parameters.items():
+                suite.metadata[name] = str(value)
+            suite.filter(
+                included_tests=self.config['debug_testcase'], 
+                included_tags=[self.config['include_tags']]
+            )
+            if self.tests is not None:
+                _select_tests(suite, self.tests)
+        listeners = []
+        if events is not None:
+            listeners.append(ProgressListener(events, self.job_name, self.result_key))
+        stdout = None
+        stderr = None
+        if not verbose:
+            stdout = open('{}.out'.format(output_base), 'w')
+            stderr = open('{}.err'.format(output_base), 'w')
+        try:
+            with span(spans, 'robot'):
+                results = self._run(suite, stdout=stdout, stderr=stderr, listeners=listeners)
+            if self.do_rerun(suite, results):
+                logger.console('{} fail rate > 50%, rerunning test'.format(suite.name))
+                with span(spans, 'rerun'):
+                    results = self._run(suite, stdout=stdout, stderr=stderr, listeners=listeners)
+        finally:
+            if not verbose:
+                stdout.close()
+                stderr.close()
+        with span(spans, 'store'):
+            self._store_output()
+        spans.append({'name': 'job', 'start': started, 'end': time()})
+        return JobResult.from_result(
+            self, results,
+            return_code=results.return_code,
+            message_length=self.config.get('max_message_length'),
+            spans=spans
         )
-        if verbose:
-            stdout = None
-            stderr = None
-        results = self._run(suite, stdout=stdout, stderr=stderr)
-        if self.do_rerun(suite, results):
-            logger.console('{} fail rate > 50%, rerunning test'.format(suite.name))
-            results = self._run(suite, stdout=stdout, stderr=stderr)
-        return results.return_code 
     
     def do_rerun(self, suite, results):
+        if self.config.get('rerun_mode') == 'failed':
+            return False
         if suite.test_count == 0:
             return results.return_code
         fail_rate = (results.return_code / float(suite.test_count))
         if self.config.get('rerun_failed') and fail_rate > 0.5:
             return True
         return False
+
+    @property
+    def selected_tests(self):
+        """
+        :return: relative names of the tests this suite runs
+        """
+        if self.tests is not None:
+            return self.tests
+        return ParseCache(self.config).tests(self.source)
+
+    def write_failed_result(self, message):
+        """
+        Writes an output in which every selected test failed with the given
+        message, for jobs that were killed or never ran, so that the log
+        trees can still be combined.
+
+        :return: a JobResult in which all tests failed
+        """
+        result = Result()
+        result.suite.name = self.result_name
+        result.suite.source = self.source
+        for name, value in self.parameters.items():
+            result.suite.metadata[name] = str(value)
+        result.suite.starttime = result.suite.endtime = get_timestamp()
+        for name in self.selected_tests:
+            parent = result.suite
+            suite_names, test_name = [], name
+            if path.isdir(self.source):
+                *suite_names, test_name = name.split('.')
+            for suite_name in suite_names:
+                children = [child for child in parent.suites if child.name == suite_name]
+                parent = children[0] if children else parent.suites.create(name=suite_name)
+            parent.tests.create(name=test_name, status='FAIL', message=message)
+        result_path = path.join(self.outputdir, self.output)
+        makedirs(path.dirname(result_path), exist_ok=True)
+        result.save(result_path)
+        self._store_output(remove_keywords=False)
+        return JobResult.from_result(
+            self, result, message_length=self.config.get('max_message_length'), synthetic=True
+        )
+
+    def moved_to(self, device):
+        """
+        Creates the same job on another device. Its results keep
+        the name of this device so they end up in the same place.
+        """
+        return ExecutableTestSuite(
+            source=self.source,
+            config=self.config,
+            tests=self.tests,
+            shard=self.shard,
+            attempt=self.attempt,
+            suite_name=self.result_name,
+            parameters=self.parameters,
+            test_name=self.test_name,
+            slots=device.slots,
+            **device
+        )
+
+    def rerun(self, tests, device=None):
+        """
+        Creates the next attempt of this suite running only the given tests
+
+        :param tests: relative names of the tests to run again
+        :param device: device to run them on, defaults to the same device
+        """
+        if device is None:
+            device = self
+        return ExecutableTestSuite(
+            source=self.source,
+            config=self.config,
+            tests=tests,
+            shard=self.shard,
+            attempt=self.attempt + 1,
+            suite_name=self.result_name,
+            parameters=self.parameters,
+            test_name=self.test_name,
+            slots=device.slots,
+            **device
+        )
     
-    def _run(self, suite, stdout, stderr):
+    def _run(self, suite, stdout, stderr, listeners=()):
         return suite.run(
+            listener=list(listeners),
             variable=self.variables,
             output=path.join(self.test_name, self.output),
             outputdir=self.config['outputdir'],
             loglevel=self.config['loglevel'],
-            name=str(self),
+            name=self.result_name,
             stdout=stdout,
             stderr=stderr
         )
 
 
+def run_job(job, events=None):
+    """
+    Runs a Job with the config of this process, in the processes of the executors
+
+    :return: the JobResult of the job
+    """
+    return ExecutableTestSuite.from_job(job, process_config()).run(events=events)
+
+
 class BuildExecutableTestSuites:
     def __init__(self, devices=None, config=None):
         if config is None:
@@ -96,34 +415,147 @@ class BuildExecutableTestSuites:
         self.devices = devices
         if not self.devices:
             self.devices = BuildDeviceList(self.config).build()
+        self.matrix = BuildParameterMatrix(self.config).build(self.devices)
 
     @staticmethod
     def _build_test_paths(test_paths):
+        """
+        Finds all .robot files in the given directories and their subdirectories.
+        Every file runs as a suite of its own, so the settings of __init__.robot
+        files, like their suite setup and teardown, are not used.
+        """
         _final_paths = []
         if not isinstance(test_paths, list):
             test_paths = [test_paths]
         for test_path in test_paths:
             if path.isdir(test_path):
-                test_files = listdir(test_path)
-                for test_file in filter(lambda x: x.endswith('.robot'), test_files):
-                    _final_paths.append(path.join(test_path, test_file))
+                for dir_path, dir_names, file_names in walk(test_path):
+                    dir_names.sort()
+                    test_files = filter(
+                        lambda x: x.endswith('.robot') and not x.startswith('__init__.'),
+                        sorted(file_names)
+                    )
+                    for test_file in test_files:
+                        _final_paths.append(path.join(dir_path, test_file))
             else:
                 _final_paths.append(test_path)
         return _final_paths
 
+    def _plan_test_paths(self, test_paths):
+        """
+        Parses all suites in parallel and drops those without
+        any test matching the --test and --include filters.
+        """
+        cache = ParseCache(self.config)
+        cache.prefetch(test_paths, processes=self.config['max_processes'])
+        planned = []
+        for test_path in test_paths:
+            if cache.tests(test_path):
+                planned.append(test_path)
+            else:
+                logger.info('skipping {}, no tests match the filters'.format(test_path))
+        return planned
+
+    @staticmethod
+    def _test_names(test_paths, cache):
+        """
+        Names every suite after its parsed name, which robot takes from the file
+        name. Suites with the same name in different directories are prefixed
+        with their directory relative to the directory the suites share, since
+        the name decides where their outputs and results go.
+
+        :return: the name of every test path
+        """
+        by_name = {}
+        for test_path in test_paths:
+            by_name.setdefault(cache.name(test_path), []).append(test_path)
+        names = {}
+        for name, same_name in by_name.items():
+            if len(same_name) == 1:
+                names[same_name[0]] = name
+                continue
+            root = path.commonpath([path.dirname(path.abspath(test_path)) for test_path in same_name])
+            for test_path in same_name:
+                directory = path.relpath(path.dirname(path.abspath(test_path)), root)
+                names[test_path] = name if directory == '.' else '.'.join(directory.split(path.sep) + [name])
+        counts = {}
+        for name in names.values():
+            counts[name] = counts.get(name, 0) + 1
+        duplicates = sorted(name for name, count in counts.items() if count > 1)
+        if duplicates:
+            raise ValueError('more than one suite is named {}, rename their files'.format(', '.join(duplicates)))
+        return names
+
+    def _split_tests(self, test_path):
+        """
+        Splits the tests of a suite into balanced chunks of at most
+        `split_tests` tests, keeping their original order.
+
+        :return: a list of test name lists, or [None] when the suite runs as one job
+        """
+        chunk_size = self.config['split_tests']
+        if not chunk_size or chunk_size < 1:
+            return [None]
+        names = ParseCache(self.config).tests(test_path)
+        if len(names) <= chunk_size:
+            return [None]
+        chunk_count = -(-len(names) // chunk_size)
+        base_size, remainder = divmod(len(names), chunk_count)
+        chunks = []
+        start = 0
+        for index in range(chunk_count):
+            end = start + base_size + (1 if index < remainder else 0)
+            chunks.append(names[start:end])
+            start = end
+        return chunks
+
+    def _parameter_sets(self):
+        """
+        :return: (device, parameters) for every parameter set of the matrix,
+            or every device without parameters when there is no matrix
+        """
+        if self.matrix is None:
+            return [(device, None) for device in self.devices]
+        devices = {str(device): device for device in self.devices}
+        parameter_sets = []
+        for parameters in self.matrix.parameter_sets():
+            device = devices.get(str(parameters.pop('device')))
+            if device is None:
+                logger.warn('skipping parameter set {}, its device is not in the devices file'.format(parameters))
+                continue
+            parameter_sets.append((device, parameters))
+        logger.info('{} coverage of the parameter matrix runs {} parameter sets'.format(
+            self.matrix.coverage, len(parameter_sets)
+        ))
+        return parameter_sets
+
     def build(self):
-        if self.config['debug_testcase']:
-            test_paths = self.config['test_file_paths']
-        else:
-            test_paths = self._build_test_paths(self.config['test_file_paths'])
+        test_paths = self._build_test_paths(self.config['test_file_paths'])
+        test_paths = self._plan_test_paths(test_paths)
+        test_names = self._test_names(test_paths, ParseCache(self.config))
+        parameter_sets = self._parameter_sets()
         executables = []
         for test_path in test_paths:
-            for device in self.devices:
-                executables.append(
-                    ExecutableTestSuite(
-                        source=test_path, 
-                        config=self.config,
-                        **device
+            chunks = self._split_tests(test_path)
+            for device, parameters in parameter_sets:
+                for shard, tests in enumerate(chunks):
+                    executables.append(
+                        ExecutableTestSuite(
+                            source=test_path, 
+                            config=self.config,
+                            test_name=test_names[test_path],
+                            tests=tests,
+                            shard=shard if tests is not None else None,
+                            parameters=parameters,
+                            slots=device.slots,
+                            **device
+                        )
                     )
-                )
+        outputs = {}
+        for executable in executables:
+            key = (executable.test_name, executable.output_name)
+            if outputs.setdefault(key, executable.result_name) != executable.result_name:
+                raise ValueError('{} and {} would write the same outputs, rename one of them'.format(
+                    outputs[key], executable.result_name
+                ))
         return executables
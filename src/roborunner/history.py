@@ -0,0 +1,287 @@
+"""
+Keeps the results of every run in a SQLite database and answers questions
+about them without reading any output xml:
+
+    roborunner history flaky --since 2019-07-01
+    roborunner history slowest --device pixel_3 --limit 20
+    roborunner history regressions --recent 5 --threshold 1.5
+
+Every test of every job is stored with its suite, device, attempt, status
+and elapsed time, after the log trees of a run are written. The database
+is .roborunner_history.sqlite in the outputdir unless --history-file says
+otherwise, and is kept when the outputs of the next run replace the others.
+"""
+from datetime import datetime
+from time import time
+from os import path, makedirs
+import argparse
+import sqlite3
+import json
+import sys
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    started REAL,
+    finished REAL,
+    tests INTEGER,
+    passed INTEGER,
+    failed INTEGER
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER REFERENCES runs(id),
+    suite TEXT,
+    device TEXT,
+    executed_on TEXT,
+    test TEXT,
+    attempt INTEGER,
+    status TEXT,
+    elapsed REAL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE INDEX IF NOT EXISTS results_test ON results (suite, test, device, run_id);
+CREATE INDEX IF NOT EXISTS results_device ON results (device, run_id);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+"""
+
+# the outcome of every test in every selected run: its final status, whether
+# it failed in an attempt and passed in another, and the final status of the
+# run before for the same test on the same device
+OUTCOMES = """
+WITH selected AS (
+    SELECT id FROM runs WHERE started >= :since ORDER BY started DESC LIMIT :runs
+), per_run AS (
+    -- status is taken from the row of the last attempt, the only MAX in the query
+    SELECT run_id, suite, device, test, status, MAX(attempt) AS attempts,
+           SUM(status = 'FAIL') > 0 AS failed_once, SUM(status = 'PASS') > 0 AS passed_once
+    FROM results
+    WHERE run_id IN (SELECT id FROM selected)
+        AND (:device IS NULL OR device = :device) AND (:suite IS NULL OR suite = :suite)
+    GROUP BY run_id, suite, device, test
+)
+SELECT run_id, suite, device, test, status, failed_once, passed_once,
+       LAG(status) OVER (PARTITION BY suite, device, test ORDER BY run_id) AS previous
+FROM per_run
+"""
+
+FLAKY = """
+WITH outcomes AS ({outcomes})
+SELECT suite, device, test, COUNT(*) AS runs,
+       SUM(status != 'PASS') AS failed,
+       SUM(failed_once AND passed_once) AS passed_on_rerun,
+       SUM(previous IS NOT NULL AND previous != status) AS flips,
+       1.0 * SUM((failed_once AND passed_once) OR (previous IS NOT NULL AND previous != status))
+           / COUNT(*) AS flakiness
+FROM outcomes
+GROUP BY suite, device, test
+HAVING flakiness > 0
+ORDER BY flakiness DESC, runs DESC, suite, test, device
+LIMIT :limit
+""".format(outcomes=OUTCOMES)
+
+SLOWEST = """
+WITH selected AS (
+    SELECT id FROM runs WHERE started >= :since ORDER BY started DESC LIMIT :runs
+)
+SELECT suite, device, test, COUNT(*) AS runs,
+       AVG(elapsed) AS average, MAX(elapsed) AS slowest
+FROM results
+WHERE run_id IN (SELECT id FROM selected) AND status = 'PASS'
+    AND (:device IS NULL OR device = :device) AND (:suite IS NULL OR suite = :suite)
+GROUP BY suite, device, test
+ORDER BY average DESC
+LIMIT :limit
+"""
+
+# the average elapsed time of passing tests in the most recent runs
+# against the average in the runs before them
+REGRESSIONS = """
+WITH ranked AS (
+    SELECT id, ROW_NUMBER() OVER (ORDER BY started DESC) AS age
+    FROM runs WHERE started >= :since
+), timed AS (
+    SELECT suite, device, test, elapsed, age <= :recent AS is_recent
+    FROM results JOIN ranked ON results.run_id = ranked.id
+    WHERE (:runs < 0 OR age <= :runs) AND status = 'PASS'
+        AND (:device IS NULL OR device = :device) AND (:suite IS NULL OR suite = :suite)
+)
+SELECT suite, device, test,
+       AVG(CASE WHEN NOT is_recent THEN elapsed END) AS earlier,
+       AVG(CASE WHEN is_recent THEN elapsed END) AS latest,
+       AVG(CASE WHEN is_recent THEN elapsed END) / AVG(CASE WHEN NOT is_recent THEN elapsed END) AS ratio
+FROM timed
+GROUP BY suite, device, test
+HAVING earlier > 0 AND latest - earlier >= :min_seconds AND ratio >= :threshold
+ORDER BY ratio DESC
+LIMIT :limit
+"""
+
+QUERIES = {
+    'flaky': FLAKY,
+    'slowest': SLOWEST,
+    'regressions': REGRESSIONS
+}
+
+
+def history_path(config):
+    return config.get('history_file') or path.join(config['outputdir'], '.roborunner_history.sqlite')
+
+
+class ResultsHistory:
+
+    def __init__(self, history_file):
+        self.path = history_file
+        makedirs(path.dirname(path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def ingest(self, summary, name=None, started=None, finished=None):
+        """
+        Stores every test of every job of a run, reruns as later attempts of the same test
+
+        :param summary: the RunSummary of the run
+        :return: the id of the run
+        """
+        finished = finished or time()
+        with self.connection:
+            run_id = self.connection.execute(
+                'INSERT INTO runs (name, started, finished, tests, passed, failed) VALUES (?, ?, ?, ?, ?, ?)',
+                (name, started or finished, finished, summary.test_count, summary.passed, summary.failed)
+            ).lastrowid
+            self.connection.executemany(
+                'INSERT INTO results (run_id, suite, device, executed_on, test, attempt, status, elapsed, message) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                self._rows(run_id, summary)
+            )
+        return run_id
+
+    @staticmethod
+    def _rows(run_id, summary):
+        attempts = {}
+        for job in summary['jobs']:
+            for test in job['tests']:
+                key = (job['result'], test['name'])
+                attempts[key] = attempts.get(key, -1) + 1
+                yield (
+                    run_id, job['test_name'], job['device'], job['executed_on'], test['name'],
+                    attempts[key], test['status'], test['elapsed'], test['message']
+                )
+
+    def query(self, name, since=None, runs=None, device=None, suite=None, limit=20,
+              recent=5, threshold=1.2, min_seconds=0.0):
+        """
+        :param name: flaky, slowest or regressions
+        :param since: only look at runs started on or after this datetime
+        :param runs: only look at this many of the latest runs
+        :param recent: for regressions, how many of the latest runs are compared to the runs before
+        :return: the rows of the query as dicts
+        """
+        parameters = {
+            'since': since.timestamp() if since else 0,
+            'runs': runs or -1,
+            'device': device,
+            'suite': suite,
+            'limit': limit,
+            'recent': recent,
+            'threshold': threshold,
+            'min_seconds': min_seconds
+        }
+        return [dict(row) for row in self.connection.execute(QUERIES[name], parameters)]
+
+
+def record_run(summary, config, started):
+    """
+    Adds a finished run to the history, a history that cannot be written
+    does not fail the run
+    """
+    from robot.api import logger
+
+    try:
+        history = ResultsHistory(history_path(config))
+        try:
+            history.ingest(summary, name=config.get('top_level_name'), started=started)
+        finally:
+            history.close()
+    except sqlite3.Error as e:
+        logger.warn('could not add the run to the history {}: {}'.format(history_path(config), e))
+
+
+def _format_table(rows):
+    if not rows:
+        return 'no results'
+    columns = list(rows[0])
+    cells = [[
+        '{:.2f}'.format(value) if isinstance(value, float) else str(value)
+        for value in row.values()
+    ] for row in rows]
+    widths = [max(len(column), *(len(row[index]) for row in cells)) for index, column in enumerate(columns)]
+    lines = ['  '.join(column.ljust(width) for column, width in zip(columns, widths))]
+    for row in cells:
+        lines.append('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+    return '\n'.join(lines)
+
+
+def run_history(args):
+    parser = argparse.ArgumentParser(
+        prog='roborunner history',
+        description='Query the results of earlier runs'
+    )
+    parser.add_argument('query', choices=sorted(QUERIES),
+                        help='flaky: tests that passed on a rerun or changed status between runs, \
+                            slowest: tests with the longest average time, \
+                            regressions: tests that got slower in the recent runs')
+    parser.add_argument('--outputdir', type=str, dest='outputdir', default='results',
+                        help='outputdir of the runs, which holds the history. Defaults to results')
+    parser.add_argument('--history-file', type=str, dest='history_file', default=None,
+                        help='SQLite history file, defaults to .roborunner_history.sqlite in the outputdir')
+    parser.add_argument('--since', type=str, dest='since', default=None,
+                        help='Only look at runs started on or after this date, as YYYY-MM-DD')
+    parser.add_argument('--runs', type=int, dest='runs', default=None,
+                        help='Only look at this many of the latest runs')
+    parser.add_argument('--device', type=str, dest='device', default=None,
+                        help='Only look at the results of this device')
+    parser.add_argument('--suite', type=str, dest='suite', default=None,
+                        help='Only look at the results of this suite')
+    parser.add_argument('--limit', type=int, dest='limit', default=20,
+                        help='Number of tests listed. Defaults to 20')
+    parser.add_argument('--recent', type=int, dest='recent', default=5,
+                        help='With regressions, compare this many of the latest runs \
+                            to the runs before them. Defaults to 5')
+    parser.add_argument('--threshold', type=float, dest='threshold', default=1.2,
+                        help='With regressions, list tests whose recent average is at least \
+                            this many times their earlier average. Defaults to 1.2')
+    parser.add_argument('--min-seconds', type=float, dest='min_seconds', default=0.0,
+                        help='With regressions, ignore tests that got slower by less than \
+                            this many seconds. Defaults to 0')
+    parser.add_argument('--json', action='store_true', dest='json', default=False,
+                        help='Print the results as json')
+    options = parser.parse_args(args)
+    history_file = history_path(vars(options))
+    if not path.exists(history_file):
+        print('history file {} does not exist'.format(history_file))
+        sys.exit(1)
+    history = ResultsHistory(history_file)
+    try:
+        rows = history.query(
+            options.query,
+            since=datetime.strptime(options.since, '%Y-%m-%d') if options.since else None,
+            runs=options.runs,
+            device=options.device,
+            suite=options.suite,
+            limit=options.limit,
+            recent=options.recent,
+            threshold=options.threshold,
+            min_seconds=options.min_seconds
+        )
+    finally:
+        history.close()
+    if options.json:
+        print(json.dumps(rows, indent=4))
+    else:
+        print(_format_table(rows))
@@ -0,0 +1,47 @@
+"""
+Runs a single Job in a fresh python process, read from stdin as a pickled
+tuple of the config of the run and the Job. Used by the subprocess executor:
+
+    python -m roborunner.job < job.pickle
+
+Suite and test events are written as json lines to stdout, followed by a
+`job_result` line with the JobResult of the job. Everything else that would
+go to stdout is sent to stderr. The exit code is the robot return code of
+the job.
+"""
+from roborunner.config import set_process_config
+from roborunner.executable_test_suite import run_job
+
+from os import dup, dup2, fdopen
+import json
+import pickle
+import sys
+
+
+class JsonLinesQueue:
+    """
+    Stand-in for the event queue of the pool executor
+    which writes every event as a json line to a file.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def put(self, event):
+        self.stream.write(json.dumps(event) + '\n')
+        self.stream.flush()
+
+
+def main():
+    config, job = pickle.loads(sys.stdin.buffer.read())
+    events = JsonLinesQueue(fdopen(dup(sys.stdout.fileno()), 'w'))
+    sys.stdout.flush()
+    dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    set_process_config(config)
+    job_result = run_job(job, events=events)
+    events.put({'event': 'job_result', 'result': job_result})
+    sys.exit(min(job_result.return_code, 250))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+from robot.api import SuiteVisitor
+
+from os import getpid
+
+
+class TestResult(dict):
+    def __init__(self, name, longname, status, elapsed, tags=(), message=''):
+        """
+        Acts like a dictionary for the outcome of a single test
+
+        :param name: name of the test relative to the executed suite
+        :param elapsed: elapsed time in seconds
+        """
+        super().__init__()
+        super().update({
+            'name': name,
+            'longname': longname,
+            'status': status,
+            'elapsed': elapsed,
+            'tags': list(tags),
+            'message': message
+        })
+
+    @property
+    def passed(self):
+        return self['status'] == 'PASS'
+
+
+class _GatherTests(SuiteVisitor):
+
+    def __init__(self, root, message_length):
+        self.prefix = root.longname + '.'
+        self.message_length = message_length
+        self.tests = []
+
+    def visit_test(self, test):
+        message = test.message
+        if self.message_length is not None and len(message) > self.message_length:
+            message = message[:self.message_length] + '...'
+        self.tests.append(TestResult(
+            name=test.longname[len(self.prefix):],
+            longname=test.longname,
+            status=test.status,
+            elapsed=test.elapsedtime / 1000.0,
+            tags=test.tags,
+            message=message
+        ))
+
+    def visit_keyword(self, keyword):
+        pass
+
+
+class JobResult(dict):
+    """
+    Compact summary of one executed job which is cheap to send from a
+    worker to the parent process: the return code, the elapsed time and
+    the status, elapsed time, tags and message of every test, plus the
+    process id of the worker and the timing spans it recorded.
+    Results written for jobs that were killed or never ran are synthetic.
+    """
+
+    def __init__(self, job, result, test_name, device, source, output,
+                 return_code, elapsed, tests=(), executed_on=None, pid=None, spans=(),
+                 synthetic=False):
+        super().__init__()
+        super().update({
+            'job': job,
+            'result': result,
+            'test_name': test_name,
+            'device': device,
+            'executed_on': executed_on or device,
+            'source': source,
+            'output': output,
+            'return_code': return_code,
+            'elapsed': elapsed,
+            'tests': [TestResult(**test) for test in tests],
+            'pid': pid,
+            'spans': list(spans),
+            'synthetic': synthetic
+        })
+
+    @classmethod
+    def from_result(cls, suite, result, return_code=None, message_length=None, spans=(),
+                    synthetic=False):
+        """
+        :param suite: the ExecutableTestSuite that was run
+        :param result: the robot Result of the run
+        :param message_length: truncate failure messages to this many characters
+        :param spans: timing spans recorded while running the job
+        :param synthetic: the result was written for a job that did not run to the end
+        """
+        gatherer = _GatherTests(result.suite, message_length)
+        result.suite.visit(gatherer)
+        if return_code is None:
+            return_code = min(len([test for test in gatherer.tests if not test.passed]), 250)
+        return cls(
+            job=suite.job_name,
+            result=suite.result_key,
+            test_name=suite.test_name,
+            device=suite.result_name,
+            executed_on=str(suite),
+            source=suite.source,
+            output=suite.output,
+            return_code=return_code,
+            elapsed=result.suite.elapsedtime / 1000.0,
+            tests=gatherer.tests,
+            pid=getpid(),
+            spans=spans,
+            synthetic=synthetic
+        )
+
+    @property
+    def return_code(self):
+        return self['return_code']
+
+    @property
+    def synthetic(self):
+        return self['synthetic']
+
+    @property
+    def test_count(self):
+        return len(self['tests'])
+
+    @property
+    def passed(self):
+        return len([test for test in self['tests'] if test.passed])
+
+    @property
+    def failed(self):
+        return self.test_count - self.passed
+
+    @property
+    def failed_tests(self):
+        """
+        :return: relative names of the tests that did not pass
+        """
+        return [test['name'] for test in self['tests'] if not test.passed]
+
+
+class RunSummary(dict):
+    """
+    Results of all jobs of a run, as returned by TestSuiteExecutor.run
+    and roborunner.run_suites. Reruns are included as separate jobs.
+    """
+
+    def __init__(self, jobs=()):
+        super().__init__()
+        super().update({'jobs': [JobResult(**job) for job in jobs]})
+
+    def add(self, job_result):
+        self['jobs'].append(job_result)
+
+    @property
+    def final_tests(self):
+        """
+        :return: the last outcome of every test, keyed by job result and test name
+        """
+        tests = {}
+        for job in self['jobs']:
+            for test in job['tests']:
+                tests[(job['result'], test['name'])] = test
+        return tests
+
+    @property
+    def test_count(self):
+        return len(self.final_tests)
+
+    @property
+    def passed(self):
+        return len([test for test in self.final_tests.values() if test.passed])
+
+    @property
+    def failed(self):
+        return self.test_count - self.passed
+
+    @property
+    def return_code(self):
+        return min(self.failed, 250)
@@ -0,0 +1,81 @@
+from roborunner.job_result import JobResult
+
+from robot.api import logger
+
+from os import path, makedirs
+import json
+
+
+class RunJournal:
+    """
+    Records every finished job as a json line in the outputdir while the run
+    is going, so a run that was interrupted can be resumed with --resume
+    without running the jobs that already finished. The end of a run is
+    recorded as well, after which the next run starts a new journal.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.path = path.join(config['outputdir'], '.roborunner_journal.jsonl')
+        self._results = None
+
+    def _load(self):
+        self._results = {}
+        if not path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a journal can be cut off by a crash
+                        continue
+                    if entry.get('finished'):
+                        self._results = {}
+                    else:
+                        self._results.setdefault(entry['job'], {})[entry['attempt']] = entry
+        except OSError as e:
+            logger.info('could not read journal {}: {}'.format(self.path, e))
+
+    def start(self):
+        """
+        Starts a new journal, forgetting the jobs of earlier runs
+        """
+        makedirs(path.dirname(path.abspath(self.path)), exist_ok=True)
+        open(self.path, 'w').close()
+        self._results = {}
+
+    def _append(self, entry):
+        with open(self.path, 'a') as journal_file:
+            journal_file.write(json.dumps(entry) + '\n')
+
+    def record(self, suite, result):
+        self._append({
+            'job': suite.job_key,
+            'attempt': suite.attempt,
+            'output': path.relpath(suite.result_path, self.config['outputdir']),
+            'result': result
+        })
+
+    def finish(self):
+        self._append({'finished': True})
+
+    def results(self, suite):
+        """
+        :return: the JobResults of every attempt of a job that finished in the
+            interrupted run, or an empty list if its first attempt did not
+            finish or one of its outputs is missing
+        """
+        if self._results is None:
+            self._load()
+        attempts = self._results.get(suite.job_key, {})
+        results = []
+        for attempt in range(len(attempts)):
+            entry = attempts.get(attempt)
+            if entry is None:
+                break
+            if not path.exists(path.join(self.config['outputdir'], entry['output'])):
+                return []
+            results.append(JobResult(**entry['result']))
+        return results
@@ -1,45 +1,392 @@
 from roborunner.config import Config
+from roborunner.tracing import tracer
 
-from robot.api import TestCaseFile, ExecutionResult, ResultWriter, logger
+from robot.api import ExecutionResult, ResultWriter, logger
 from robot.result.executionresult import Result
+from robot.utils import get_timestamp
+from robot.version import get_full_version
+
+from multiprocessing import Pool, Process, get_start_method
+from xml.sax import SAXException, parse as parse_xml
+from xml.sax.handler import ContentHandler
+from xml.sax.saxutils import XMLGenerator
+from xml.sax.xmlreader import AttributesImpl
+from tempfile import mkdtemp, mkstemp
+from urllib.parse import quote
+from itertools import starmap
+from copy import deepcopy
+from os import path, close, remove
+from time import time
+import shutil
+import gzip
+
+
+def _open_output(result_path):
+    """
+    :return: the path of an output xml, or an opened file which decompresses
+        it for outputs stored with --compress-outputs
+    """
+    if result_path.endswith('.gz'):
+        return gzip.open(result_path, 'rb')
+    return result_path
+
+
+def _close_outputs(sources):
+    for source in sources:
+        if not isinstance(source, str):
+            source.close()
+
+
+def _merge_suite(target, source):
+    """
+    Moves the tests of a shard result into the result of an earlier
+    shard of the same suite, matching child suites by name.
+    """
+    target.tests.extend(list(source.tests))
+    for source_child in list(source.suites):
+        matches = [child for child in target.suites if child.name == source_child.name]
+        if matches:
+            _merge_suite(matches[0], source_child)
+        else:
+            target.suites.append(source_child)
+    if source.endtime not in (None, 'N/A') and \
+            (target.endtime in (None, 'N/A') or source.endtime > target.endtime):
+        target.endtime = source.endtime
+
+
+def _load_job(suites):
+    """
+    Parses the outputs of one suite on one device, combining shards
+    and merging the reruns of failed tests into the first attempt.
+
+    :return: the result suite, or None if no output could be parsed
+    """
+    merged = None
+    for suite in sorted(suites, key=lambda suite: suite.shard or 0):
+        result_path = suite.result_path
+        try:
+            sources = [_open_output(output) for output in [result_path] + suite.rerun_outputs]
+        except OSError as e:
+            logger.error('unable to open log file {}: {}'.format(result_path, e))
+            continue
+        try:
+            # reruns of failed tests are merged like `rebot --merge` does: a
+            # rerun test takes the status of the new attempt, and its message
+            # is prefixed with the status and message of the earlier one
+            result = ExecutionResult(*sources, merge=True)
+        except Exception as e:
+            logger.error('unable to parse log file {}: {}'.format(result_path, e))
+            continue
+        finally:
+            _close_outputs(sources)
+        if merged is None:
+            merged = result.suite
+        else:
+            _merge_suite(merged, result.suite)
+    return merged
+
+
+def _copy_suite(suite):
+    """
+    Copies a result suite without copying the tree it is attached to,
+    so the same worker result can be placed in more than one log tree.
+    """
+    parent = suite.parent
+    suite.parent = None
+    try:
+        return deepcopy(suite)
+    finally:
+        suite.parent = parent
+
+
+# the ids in a job fragment start with this instead of the id of the job suite,
+# which is only known when the fragment is copied into a log tree
+FRAGMENT_ID = '@@roborunner-job@@'
+FRAGMENT_CHUNK = 1024 * 1024
+
+
+class _SuiteCopy(ContentHandler):
+    """
+    Copies everything below the top level suite of an output xml to an
+    XMLGenerator while it is being read, replacing the id of the top level
+    suite with FRAGMENT_ID in the ids below it.
+    """
+
+    def __init__(self, generator):
+        super().__init__()
+        self.generator = generator
+        self.attributes = None
+        self._depth = 0
+
+    def startElement(self, tag, attrs):
+        if self._depth:
+            self._depth += 1
+            attributes = dict(attrs)
+            if attributes.get('id', '').startswith('s1-'):
+                attributes['id'] = FRAGMENT_ID + attributes['id'][2:]
+            self.generator.startElement(tag, AttributesImpl(attributes))
+        elif tag == 'suite' and self.attributes is None:
+            # the statistics further down have suite elements of their own
+            self.attributes = dict(attrs)
+            self._depth = 1
+
+    def endElement(self, tag):
+        if self._depth > 1:
+            self.generator.endElement(tag)
+        if self._depth:
+            self._depth -= 1
+
+    def characters(self, content):
+        if self._depth > 1:
+            self.generator.characters(content)
+
+
+def _write_job(suites, fragment_path):
+    """
+    Parses the outputs of one suite on one device like _load_job, writes the
+    log of that job next to its outputs and the contents of its suite to
+    fragment_path, to be copied into the log trees with --merge-mode streaming.
+    Only paths and names are returned, so the result suite is freed as soon
+    as the job is written, also when this runs in a merge process.
+
+    :return: the name, source, log and fragment of the job, or None if no output could be parsed
+    """
+    merged = _load_job(suites)
+    if merged is None:
+        return None
+    result = Result(root_suite=merged)
+    handle, result_path = mkstemp(suffix='.xml', dir=path.dirname(fragment_path))
+    close(handle)
+    try:
+        result.save(result_path)
+        with open(fragment_path, 'w', encoding='utf-8') as fragment:
+            copy = _SuiteCopy(XMLGenerator(fragment, 'UTF-8'))
+            parse_xml(result_path, copy)
+    except (SAXException, OSError) as e:
+        logger.error('unable to write the results of {}: {}'.format(suites[0].result_path, e))
+        return None
+    finally:
+        remove(result_path)
+    log_path = path.abspath(path.join(suites[0].outputdir, suites[0].output_name + '.html'))
+    ResultWriter(result).write_results(
+        output=None,
+        log=log_path,
+        report=None
+    )
+    return {
+        'name': copy.attributes.get('name'),
+        'source': copy.attributes.get('source'),
+        'log': log_path,
+        'fragment': fragment_path
+    }
+
+
+def _copy_fragment(fragment_path, output_file, suite_id):
+    """
+    Copies a job fragment into an output xml in chunks, giving the ids
+    in it the id of the suite it is copied to.
+    """
+    # a chunk can end in the middle of FRAGMENT_ID, so the last characters
+    # of every chunk are only written with the next one
+    keep = len(FRAGMENT_ID) - 1
+    pending = ''
+    with open(fragment_path, encoding='utf-8') as fragment:
+        for chunk in iter(lambda: fragment.read(FRAGMENT_CHUNK), ''):
+            chunk = (pending + chunk).replace(FRAGMENT_ID, suite_id)
+            output_file.write(chunk[:-keep])
+            pending = chunk[-keep:]
+    output_file.write(pending)
+
+
+class WorkerResults:
+    """
+    Parses the output of every executed test suite exactly once and keeps
+    the resulting suites in memory, so both log trees can be built from
+    them without writing and re-reading intermediate xml files.
+    Outputs of a split suite are combined into one suite per device.
+    """
+
+    def __init__(self, executable_test_suites, config=None):
+        if config is None:
+            config = {}
+        self.config = Config(**config)
+        self._jobs = {}
+        for suite in executable_test_suites:
+            self._jobs.setdefault((suite.test_name, suite.result_name), []).append(suite)
+        self._suites = None
+
+    @property
+    def test_names(self):
+        return sorted({test_name for test_name, _ in self._jobs})
+
+    @property
+    def devices(self):
+        return sorted({device for _, device in self._jobs})
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def load(self):
+        # the outputs are parsed in this process: sending every parsed suite
+        # back from a pool costs more than parsing it, so merge processes only
+        # parse jobs that are written where they are parsed, see write_jobs
+        if self._suites is not None:
+            return self._suites
+        self._suites = {}
+        for key, suites in self._jobs.items():
+            merged = _load_job(suites)
+            if merged is not None:
+                self._suites[key] = merged
+        return self._suites
+
+    def get(self, test_name, device):
+        return self.load().get((test_name, device))
+
+    def write_jobs(self, directory, processes=1):
+        """
+        Writes the log and the fragment of every job with _write_job instead
+        of keeping the parsed suites, see --merge-mode streaming.
+
+        :param directory: where the fragments are written
+        :param processes: write the jobs on a pool of this many processes
+        :return: what _write_job returned for every job with a parsable output,
+            keyed by test name and device
+        """
+        keys = list(self._jobs)
+        jobs = [
+            (self._jobs[key], path.join(directory, '{}.xml'.format(index)))
+            for index, key in enumerate(keys)
+        ]
+        if processes > 1 and len(jobs) > 1:
+            with Pool(processes=min(processes, len(jobs))) as pool:
+                written = pool.starmap(_write_job, jobs, chunksize=1)
+        else:
+            written = starmap(_write_job, jobs)
+        return {key: job for key, job in zip(keys, written) if job is not None}
 
-from os import path, listdir
 
 class LogTree:
-    def __init__(self, executable_test_suites, name, config=None):
+    def __init__(self, executable_test_suites, name, config=None, results=None):
         """
 
         :param executable_test_suites:
         :param name:
         :param config:
+        :param results: WorkerResults shared with other log trees, loaded on demand if not given
         """
         if config is None:
             config = {}
-        self._test_paths = list({*map(lambda x: x.source, executable_test_suites)})
         self.name = name
         self.config = Config(**config)
+        self.results = results
+        if self.results is None:
+            self.results = WorkerResults(executable_test_suites, self.config)
 
-    def write(self):
+    def build(self):
         raise NotImplementedError()
 
-    @property
-    def test_names(self):
-        test_names = []
-        for test_path in self._test_paths:
-            test_names.append(TestCaseFile(source=test_path).name)
-        return test_names
+    def groups(self):
+        """
+        :return: (name, [(name, test_name, device), ...]) for every child of the top
+            level suite, listing the jobs below it and the names they get in the tree.
+            A job keeps the name of its suite if its name is None
+        """
+        raise NotImplementedError()
 
-    @property
-    def result_paths(self):
-        _result_paths = []
-        for test_name in self.test_names:
-            _result_paths.append(
-                path.join(
-                    self.config['outputdir'],
-                    test_name + '.xml'
-                )
+    def write(self):
+        with tracer.span('build {}'.format(type(self).__name__)):
+            result = self.build()
+        with tracer.span('write {}'.format(type(self).__name__)):
+            writer = ResultWriter(result)
+            writer.write_results(
+                suitestatlevel=self.config['suite_stat_level'],
+                outputdir=self.config['outputdir'],
+                output=self.output,
+                log=self.log,
+                report=self.report
+            )
+
+    def write_streaming(self, jobs):
+        """
+        Writes the output xml of the tree by copying the fragments of the jobs
+        into it one at a time, then writes the log and report from that xml
+        without keywords. The keywords are in the log of every job, which is
+        linked from the metadata of its suite.
+
+        :param jobs: the jobs written by WorkerResults.write_jobs
+        """
+        output_path = path.join(self.config['outputdir'], self.output)
+        with tracer.span('stream {}'.format(type(self).__name__)):
+            logs = self._stream(output_path, jobs)
+        with tracer.span('write {}'.format(type(self).__name__)):
+            result = ExecutionResult(output_path, include_keywords=False)
+            for group, group_logs in zip(result.suite.suites, logs):
+                for suite, log_path in zip(group.suites, group_logs):
+                    link = path.relpath(log_path, self.config['outputdir']).replace(path.sep, '/')
+                    suite.metadata['Log'] = '[{}|{}]'.format(quote(link), path.basename(log_path))
+            writer = ResultWriter(result)
+            writer.write_results(
+                suitestatlevel=self.config['suite_stat_level'],
+                outputdir=self.config['outputdir'],
+                output=None,
+                log=self.log,
+                report=self.report
             )
-        return sorted(_result_paths)
+
+    @staticmethod
+    def _write_status(generator):
+        # the status and times of combined suites are computed from their children
+        generator.startElement('status', AttributesImpl({'status': 'PASS', 'starttime': 'N/A', 'endtime': 'N/A'}))
+        generator.endElement('status')
+
+    def _stream(self, output_path, jobs):
+        """
+        :return: the logs of the jobs copied into every group
+        """
+        logs = []
+        with open(output_path, 'w', encoding='utf-8') as output_file:
+            # XMLGenerator writes to a text file directly, so the fragments
+            # can be copied into the same file between its elements
+            generator = XMLGenerator(output_file, 'UTF-8')
+            generator.startDocument()
+            generator.startElement('robot', AttributesImpl({
+                'generator': get_full_version('Rebot'),
+                'generated': get_timestamp()
+            }))
+            generator.startElement('suite', AttributesImpl({'id': 's1', 'name': self.name}))
+            for group_index, (group_name, group_jobs) in enumerate(self.groups(), 1):
+                group_id = 's1-s{}'.format(group_index)
+                generator.startElement('suite', AttributesImpl({'id': group_id, 'name': group_name}))
+                group_logs = []
+                for name, test_name, device in group_jobs:
+                    job = jobs.get((test_name, device))
+                    if job is None:
+                        continue
+                    suite_id = '{}-s{}'.format(group_id, len(group_logs) + 1)
+                    attributes = {'id': suite_id, 'name': name or job['name']}
+                    if job['source']:
+                        attributes['source'] = job['source']
+                    generator.startElement('suite', AttributesImpl(attributes))
+                    _copy_fragment(job['fragment'], output_file, suite_id)
+                    generator.endElement('suite')
+                    group_logs.append(job['log'])
+                logs.append(group_logs)
+                self._write_status(generator)
+                generator.endElement('suite')
+            self._write_status(generator)
+            generator.endElement('suite')
+            # rebot computes the statistics from the suites when it reads the xml
+            generator.startElement('statistics', AttributesImpl({}))
+            generator.endElement('statistics')
+            generator.startElement('errors', AttributesImpl({}))
+            generator.endElement('errors')
+            generator.endElement('robot')
+            generator.endDocument()
+        return logs
+
+    @property
+    def test_names(self):
+        return self.results.test_names
 
 
 class SuiteLogTree(LogTree):
@@ -58,95 +405,126 @@ class SuiteLogTree(LogTree):
     log files after execution. This class aims to make a clear, hierarchy of logs
     and suites.
     """
+    output = 'output.xml'
+    log = 'log.html'
+    report = 'report.html'
 
-    def __init__(self, executable_test_suites, name, config=None):
-        super().__init__(executable_test_suites, name, config)
+    def __init__(self, executable_test_suites, name, config=None, results=None):
+        super().__init__(executable_test_suites, name, config, results)
 
-    def _create_suite_xml(self, test_name):
-        dir_path = path.join(self.config['outputdir'], test_name)
-        result = Result()
-        result.suite.name = test_name
-
-        result_files = listdir(dir_path)
-        result_files = [*filter(lambda result_file: result_file.endswith('.xml'), result_files)]
-        result_files = [*map(lambda result_file: path.join(dir_path, result_file), result_files)]
-        for result_file in result_files:
-            try:
-                new_result = ExecutionResult(result_file)
-                result.suite.suites.append(new_result.suite)
-            except Exception as e:
-                logger.info('could not parse result file {}: {}'.format(result_file, e))
-        result.save(path.join(self.config['outputdir'], test_name + '.xml'))
-
-    def _create_suite_xmls(self):
-        for name in self.test_names:
-            self._create_suite_xml(name)
-
-    def _combine_suite_xmls(self):
+    def build(self):
         result = Result()
         result.suite.name = self.name
-        for result_path in self.result_paths:
-            new_result = ExecutionResult(result_path)
-            result.suite.suites.append(new_result.suite)
-        result.save(path=path.join(self.config['outputdir'], 'output.xml'))
+        for test_name in self.test_names:
+            suite_result = result.suite.suites.create(name=test_name)
+            for device in self.results.devices:
+                device_result = self.results.get(test_name, device)
+                if device_result is not None:
+                    suite_result.suites.append(device_result)
+        return result
+
+    def groups(self):
+        return [
+            (test_name, [(None, test_name, device) for device in self.results.devices])
+            for test_name in self.test_names
+        ]
+
 
-    def write(self):
-        self._create_suite_xmls()
-        self._combine_suite_xmls()
-        writer = ResultWriter(path.join(self.config['outputdir'], 'output.xml'))
-        writer.write_results(
-            suitestatlevel=self.config['suite_stat_level'],
-            outputdir=self.config['outputdir'],
-        )
 
 class DeviceLogTree(LogTree):
+    #        top level
+    #     /    /     \     \
+    #   d     d       d     d
+    #  / \   / \     / \   / \
+    # s   s s   s   s   s s   s
+    #
+    # the same results as the SuiteLogTree, grouped by device first
+    output = 'devices.xml'
+    log = 'devices.html'
+    report = None
 
-    def __init__(self, executable_test_suites, name, config=None):
-        super().__init__(executable_test_suites, name, config)
-        self._device_filenames = None
-    
-    @property
-    def device_filenames(self):
-        if self._device_filenames:
-            return self._device_filenames
-        dir_path = path.join(self.config['outputdir'], self.test_names[0])
-        result_files = listdir(dir_path)
-        device_xml_files = [*filter(lambda result_file: result_file.endswith('.xml'), result_files)]
-        self._device_filenames = sorted(device_xml_files)
-        return self._device_filenames
-    
-    def _gather_device_xmls(self):
-        for device_file in self.device_filenames:
-            device_result = Result()
-            device_result.name = device_file.replace('.xml', '')
+    def __init__(self, executable_test_suites, name, config=None, results=None):
+        super().__init__(executable_test_suites, name, config, results)
+
+    def build(self):
+        result = Result()
+        result.suite.name = self.name
+        for device in self.results.devices:
+            device_result = result.suite.suites.create(name=device)
             for test_name in self.test_names:
-                current_result_path = path.join(self.config['outputdir'], test_name, device_file)
-                try:
-                    current_result = ExecutionResult(current_result_path)
-                    current_result.suite.name = test_name
-                    device_result.suite.suites.append(current_result.suite)
-                except Exception as e:
-                    logger.error('unable to parse log file {}: {}'.format(current_result_path, e))
-            device_result.save(path=path.join(self.config['outputdir'], device_file))
-    
-    def _combine_all_devices(self):
-        all_devices = Result()
-        all_devices.suite.name = self.name
-
-        for device_file in self.device_filenames:
-            current_result = ExecutionResult(path.join(self.config['outputdir'], device_file))
-            current_result.suite.name = device_file
-            all_devices.suite.suites.append(current_result.suite)
-        all_devices.save(path=path.join(self.config['outputdir'], 'devices.xml'))
+                suite_result = self.results.get(test_name, device)
+                if suite_result is None:
+                    continue
+                suite_result = _copy_suite(suite_result)
+                suite_result.name = test_name
+                device_result.suites.append(suite_result)
+        return result
+
+    def groups(self):
+        return [
+            (device, [(test_name, test_name, device) for test_name in self.test_names])
+            for device in self.results.devices
+        ]
 
-    def write(self):
-        self._gather_device_xmls()
-        self._combine_all_devices()
-        writer = ResultWriter(path.join(self.config['outputdir'], 'devices.xml'))
-        writer.write_results(
-            suitestatlevel=self.config['suite_stat_level'],
-            outputdir=self.config['outputdir'],
-            log='devices.html',
-            report=None
-        )
 
+
+def write_log_trees(executable_test_suites, config):
+    """
+    Parses every worker output once and writes both the suite and the device
+    log trees from it. With more than one merge process the two trees are
+    written concurrently where processes are forked or with --merge-mode
+    streaming, which also writes the jobs on a pool of merge processes.
+    """
+    processes = max(1, config.get('merge_processes') or 1)
+    streaming = config.get('merge_mode') == 'streaming'
+    started = time()
+    results = WorkerResults(executable_test_suites, config=config)
+    fragments = None
+    try:
+        if streaming:
+            fragments = mkdtemp(prefix='.roborunner-merge-', dir=config['outputdir'])
+            with tracer.span('write job logs'):
+                jobs = results.write_jobs(fragments, processes=processes)
+        else:
+            with tracer.span('parse outputs'):
+                results.load()
+        loaded = time()
+        trees = [
+            SuiteLogTree(executable_test_suites, name=config['top_level_name'], config=config, results=results),
+            DeviceLogTree(executable_test_suites, name=config['top_level_name'], config=config, results=results)
+        ]
+        if streaming:
+            targets = [(tree.write_streaming, (jobs,)) for tree in trees]
+        else:
+            targets = [(tree.write, ()) for tree in trees]
+        # in memory mode the writer processes inherit the parsed results, where
+        # spawned processes would get a pickled copy of every suite, so the trees
+        # are only written concurrently with fork. Streaming trees only hold the
+        # paths of the job fragments
+        if processes > 1 and (streaming or get_start_method() == 'fork'):
+            # the spans of the trees are recorded in the writer processes, so
+            # the trace only shows how long writing both of them took
+            writers = [
+                Process(target=target, args=args, name=type(tree).__name__)
+                for tree, (target, args) in zip(trees, targets)
+            ]
+            with tracer.span('write log trees'):
+                for writer in writers:
+                    writer.start()
+                for writer in writers:
+                    writer.join()
+                    if writer.exitcode:
+                        logger.error('{} exited with code {}'.format(writer.name, writer.exitcode))
+        else:
+            for target, args in targets:
+                target(*args)
+    finally:
+        if fragments is not None:
+            shutil.rmtree(fragments, ignore_errors=True)
+    finished = time()
+    logger.info(
+        'merged {} outputs on {} process(es) in {:.2f}s (parsing {:.2f}s, writing logs {:.2f}s)'.format(
+            len(results), processes, finished - started, loaded - started, finished - loaded
+        ),
+        also_console=True
+    )
@@ -0,0 +1,155 @@
+from roborunner.config import Config
+
+from robot.api import logger
+
+from itertools import combinations, product
+from os import path
+import json
+
+# how many axes every generated combination of values spans
+COVERAGE_STRENGTH = {'pairwise': 2, 'n-wise': 3}
+
+
+class ParameterMatrix:
+    """
+    Named parameter axes, from the `matrix` section of the devices file:
+
+        "matrix": {
+            "axes": {
+                "os": ["13", "14"],
+                "locale": ["en_US", "de_DE", "ja_JP"],
+                "orientation": ["portrait", "landscape"]
+            },
+            "exclude": [{"os": "13", "locale": "ja_JP"}],
+            "coverage": "pairwise"
+        }
+
+    The devices are an axis named `device` of their own, unless the axes list
+    the device names themselves. A parameter set which matches every key of an
+    exclusion is never run, an exclusion value can be a list of values.
+    Coverage `full` runs every combination of values, `pairwise` covers
+    every pair of values of any two axes at least once and `n-wise` every
+    combination of `strength` axes, which defaults to 3.
+    """
+
+    def __init__(self, axes, exclude=(), coverage='pairwise', strength=None):
+        """
+
+        :param axes: list of (name, values) in the order of the matrix section
+        """
+        if coverage not in ('full', 'pairwise', 'n-wise'):
+            raise ValueError('unknown matrix coverage {}'.format(coverage))
+        self.axes = axes
+        self.exclude = list(exclude)
+        self.coverage = coverage
+        if coverage == 'pairwise' or not strength:
+            strength = COVERAGE_STRENGTH.get(coverage)
+        self.strength = strength
+
+    def excluded(self, parameters):
+        """
+        :param parameters: values of some or all axes by name
+        :return: whether the parameters match every key of one of the exclusions
+        """
+        for exclusion in self.exclude:
+            matches = True
+            for name, value in exclusion.items():
+                values = value if isinstance(value, list) else [value]
+                if name not in parameters or parameters[name] not in values:
+                    matches = False
+                    break
+            if matches:
+                return True
+        return False
+
+    def _named(self, row):
+        return {self.axes[axis][0]: self.axes[axis][1][value] for axis, value in sorted(row.items())}
+
+    def _full(self):
+        names = [name for name, _ in self.axes]
+        rows = [dict(zip(names, values)) for values in product(*(values for _, values in self.axes))]
+        return [row for row in rows if not self.excluded(row)]
+
+    def _covering(self, strength):
+        """
+        Builds a covering array greedily: every row starts from a combination
+        that is not covered yet and takes the value of each remaining axis which
+        covers the most combinations not covered yet.
+        Combinations are kept as tuples of (axis index, value index).
+        """
+        uncovered = set()
+        for axes in combinations(range(len(self.axes)), strength):
+            for values in product(*(range(len(self.axes[axis][1])) for axis in axes)):
+                combination = tuple(zip(axes, values))
+                if not self.excluded(self._named(dict(combination))):
+                    uncovered.add(combination)
+        rows = []
+        while uncovered:
+            seed = min(uncovered)
+            row = dict(seed)
+            for axis in range(len(self.axes)):
+                if axis in row:
+                    continue
+                best, best_count = None, -1
+                for value in range(len(self.axes[axis][1])):
+                    if self.excluded(self._named({**row, axis: value})):
+                        continue
+                    count = sum(
+                        1 for others in combinations(sorted(row.items()), strength - 1)
+                        if tuple(sorted(others + ((axis, value),))) in uncovered
+                    )
+                    if count > best_count:
+                        best, best_count = value, count
+                if best is None:
+                    row = None
+                    break
+                row[axis] = best
+            if row is None:
+                logger.warn('no parameter set covers {} without matching an exclusion'.format(
+                    self._named(dict(seed))
+                ))
+                uncovered.discard(seed)
+                continue
+            uncovered.difference_update(combinations(sorted(row.items()), strength))
+            rows.append(self._named(row))
+        return rows
+
+    def parameter_sets(self):
+        """
+        :return: the parameter sets the coverage asks for, as dicts of values by axis name
+        """
+        if self.coverage == 'full' or self.strength >= len(self.axes):
+            return self._full()
+        return self._covering(max(1, self.strength))
+
+
+class BuildParameterMatrix:
+    def __init__(self, config=None):
+        if config is None:
+            config = {}
+        self.config = Config(**config)
+
+    def build(self, devices):
+        """
+        :param devices: the devices of the run, which become the `device` axis
+        :return: a ParameterMatrix, or None when the devices file has no matrix section
+        """
+        if not path.exists(self.config['devices_file']):
+            return None
+        with open(self.config['devices_file'], 'r') as devices_file:
+            section = json.loads(devices_file.read()).get('matrix')
+        if not section:
+            return None
+        axes = list(section.get('axes', {}).items())
+        device_names = [str(device) for device in devices]
+        if 'device' not in section.get('axes', {}):
+            axes.insert(0, ('device', device_names))
+        elif self.config['local_device']:
+            logger.warn('--local runs the matrix on the local device, ignoring its device axis')
+            axes = [(name, device_names if name == 'device' else values) for name, values in axes]
+        return ParameterMatrix(
+            axes,
+            exclude=section.get('exclude', ()),
+            coverage=self.config.get('coverage') or section.get('coverage', 'pairwise'),
+            strength=self.config.get('coverage_strength') or section.get('strength')
+        )
@@ -0,0 +1,216 @@
+from robot.api import TestCaseFile, TestData, TestDataDirectory, TestSuiteBuilder, logger
+
+from multiprocessing import Pool
+from os import path, stat, makedirs, walk
+import json
+
+# bumped whenever the parsed entries change shape, so old cache files are not used
+CACHE_VERSION = 2
+
+# parsed suites of this process, shared by every ParseCache instance
+_parsed = {}
+_loaded_files = set()
+
+
+def relative_test_names(suite, prefix=''):
+    """
+    Names of all tests in the suite, relative to the suite itself,
+    e.g. `Child Suite.Test Name` for a test in a child suite.
+    """
+    names = [prefix + test.name for test in suite.tests]
+    for child in suite.suites:
+        names.extend(relative_test_names(child, prefix + child.name + '.'))
+    return names
+
+
+def import_path(item):
+    """
+    :return: absolute path of an imported resource, variable or library file,
+        or None if the import does not refer to an existing file
+    """
+    directory = path.abspath(item.directory or '.')
+    candidate = path.join(directory, item.name.replace('${CURDIR}', directory))
+    if path.isfile(candidate):
+        return path.abspath(candidate)
+    return None
+
+
+def _data_test_names(data, prefix=''):
+    """
+    relative_test_names for the parsing model of a suite
+    """
+    names = [prefix + test.name for test in data.testcase_table.tests]
+    for child in getattr(data, 'children', []):
+        names.extend(_data_test_names(child, prefix + child.name + '.'))
+    return names
+
+
+def _suite_files(suite, source):
+    """
+    :return: the files of a parsed suite and the files it imports directly
+    """
+    return _source_files(source, _walk_suites(suite, lambda current: (
+        current.source, current.resource.imports, current.suites
+    )))
+
+
+def _data_files(data, source):
+    """
+    _suite_files for the parsing model of a suite
+    """
+    return _source_files(source, _walk_suites(data, lambda current: (
+        current.source, current.setting_table.imports, getattr(current, 'children', [])
+    )))
+
+
+def _walk_suites(suite, parts):
+    """
+    :param parts: returns the source, the imports and the child suites of a suite
+    :return: the source and the imports of the suite and every suite below it
+    """
+    pending = [suite]
+    while pending:
+        source, imports, children = parts(pending.pop())
+        yield source, imports
+        pending.extend(children)
+
+
+def _source_files(source, suites):
+    files = set()
+    if path.isdir(source):
+        for dir_path, dir_names, file_names in walk(source):
+            files.update(
+                path.abspath(path.join(dir_path, file_name))
+                for file_name in file_names if file_name.startswith('__init__.')
+            )
+    for suite_source, imports in suites:
+        if suite_source and path.isfile(suite_source):
+            files.add(path.abspath(suite_source))
+        for item in imports:
+            imported = import_path(item)
+            if imported is not None:
+                files.add(imported)
+    return sorted(files)
+
+
+def _parse(source, debug_testcase, include_tags):
+    if not debug_testcase and not include_tags:
+        # robot's parsing model has every test and import, the running model
+        # is only built when the tests have to be filtered
+        data = TestData(source=source)
+        return {'name': data.name, 'tests': _data_test_names(data), 'files': _data_files(data, source)}
+    suite = TestSuiteBuilder().build(source)
+    name = suite.name
+    files = _suite_files(suite, source)
+    suite.filter(included_tests=debug_testcase, included_tags=[include_tags])
+    return {'name': name, 'tests': relative_test_names(suite), 'files': files}
+
+
+def _parse_job(job):
+    return _parse(*job)
+
+
+class ParseCache:
+    """
+    Remembers the name, the selected tests and the files of every parsed
+    suite, including the files it imports directly, so each
+    file goes through the robot parser once per process instead of once per
+    device and per lookup. Entries are keyed by path, mtime and size of the
+    file plus the active --test and --include filters. Only a test selection
+    needs robot's running model to be built, otherwise files are only parsed.
+    With --parse-cache the entries are also kept in the outputdir between runs,
+    without those of files that were changed or removed since.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.path = None
+        if config.get('parse_cache'):
+            self.path = path.join(config['outputdir'], '.roborunner_parse_cache.json')
+            self._load()
+
+    def _load(self):
+        if self.path in _loaded_files:
+            return
+        _loaded_files.add(self.path)
+        if not path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as cache_file:
+                _parsed.update(json.loads(cache_file.read()))
+        except (OSError, ValueError) as e:
+            logger.info('could not read parse cache {}: {}'.format(self.path, e))
+
+    def key(self, source):
+        source_stat = stat(source)
+        return json.dumps([
+            CACHE_VERSION,
+            path.abspath(source),
+            source_stat.st_mtime,
+            source_stat.st_size,
+            self.config['debug_testcase'],
+            self.config['include_tags']
+        ])
+
+    def get(self, source):
+        """
+        :return: a dict with the suite `name`, the relative names of its selected `tests`
+            and the `files` of the suite and its direct imports
+        """
+        key = self.key(source)
+        if key not in _parsed:
+            _parsed[key] = _parse(source, self.config['debug_testcase'], self.config['include_tags'])
+        return _parsed[key]
+
+    def prefetch(self, sources, processes=1):
+        """
+        Parses all sources that are not cached yet, on a pool of processes
+        """
+        keys = {source: self.key(source) for source in sources}
+        missing = [source for source in sources if keys[source] not in _parsed]
+        if processes <= 1 or len(missing) <= 1:
+            for source in missing:
+                self.get(source)
+            return
+        jobs = [
+            (source, self.config['debug_testcase'], self.config['include_tags'])
+            for source in missing
+        ]
+        with Pool(processes=min(processes, len(missing))) as pool:
+            for source, entry in zip(missing, pool.map(_parse_job, jobs)):
+                _parsed[keys[source]] = entry
+
+    def name(self, source):
+        """
+        The name robot gives the suite, taken from its path without parsing it
+        """
+        key = self.key(source)
+        if key in _parsed:
+            return _parsed[key]['name']
+        if path.isdir(source):
+            return TestDataDirectory(source=source).name
+        return TestCaseFile(source=source).name
+
+    def tests(self, source):
+        return self.get(source)['tests']
+
+    def files(self, source):
+        return self.get(source)['files']
+
+    def save(self):
+        if self.path is None:
+            return
+        makedirs(path.dirname(path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'w') as cache_file:
+            cache_file.write(json.dumps({key: entry for key, entry in _parsed.items() if self._current(key)}))
+
+    @staticmethod
+    def _current(key):
+        """
+        :return: whether the entry of a key was parsed from the file as it is now
+        """
+        version, source, mtime, size = json.loads(key)[:4]
+        if version != CACHE_VERSION or not path.exists(source):
+            return False
+        source_stat = stat(source)
+        return source_stat.st_mtime == mtime and source_stat.st_size == size
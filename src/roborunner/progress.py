@@ -0,0 +1,160 @@
+from robot.api import logger
+
+from threading import Thread
+from datetime import timedelta
+from time import time
+import json
+
+
+class ProgressListener:
+    """
+    Robot listener attached to every executed suite. Pushes the start and
+    end of suites and tests onto a queue shared with the parent process.
+    """
+    ROBOT_LISTENER_API_VERSION = 2
+
+    def __init__(self, queue, job, result=None):
+        """
+
+        :param queue: a queue (or queue proxy) the parent reads events from
+        :param job: name of the job the events belong to
+        :param result: name of the suite and device result the job contributes to,
+            shared between the reruns of a job
+        """
+        self.queue = queue
+        self.job = job
+        self.result = result or job
+
+    def _put(self, event, name, attrs, **extra):
+        message = {
+            'event': event,
+            'job': self.job,
+            'result': self.result,
+            'name': name,
+            'longname': attrs.get('longname'),
+            'time': time()
+        }
+        message.update(extra)
+        self.queue.put(message)
+
+    def start_suite(self, name, attrs):
+        self._put('start_suite', name, attrs)
+
+    def end_suite(self, name, attrs):
+        self._put('end_suite', name, attrs, status=attrs['status'], elapsed=attrs['elapsedtime'])
+
+    def start_test(self, name, attrs):
+        self._put('start_test', name, attrs)
+
+    def end_test(self, name, attrs):
+        self._put('end_test', name, attrs, status=attrs['status'], elapsed=attrs['elapsedtime'])
+
+
+class ProgressReporter(Thread):
+    """
+    Reads the events of all jobs from one queue and prints a compact progress
+    line: finished/total tests, passed and failed tests, finished jobs and an
+    estimate of the remaining time. Every event can also be written as a json
+    line to an events file.
+    """
+
+    def __init__(self, queue, total_tests, total_jobs, events_file=None, console=True, interval=1.0):
+        super().__init__(name='progress_reporter', daemon=True)
+        self.queue = queue
+        self.total_tests = total_tests
+        self.total_jobs = total_jobs
+        self.console = console
+        self.interval = interval
+        self.events_file = events_file
+        self._events = None
+        self._tests = {}
+        self._jobs = 0
+        self._start_time = time()
+        self._last_print = 0
+
+    def job_finished(self, job, result):
+        """
+        Called from the parent when a job completed, which also gets
+        reported for jobs that never reached the robot listener.
+
+        :param result: the JobResult of the job
+        """
+        self.queue.put({
+            'event': 'end_job',
+            'job': job,
+            'return_code': result.return_code,
+            'passed': result.passed,
+            'failed': result.failed,
+            'elapsed': result['elapsed'],
+            'time': time()
+        })
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    @property
+    def finished_tests(self):
+        return len(self._tests)
+
+    @property
+    def failed_tests(self):
+        return len([status for status in self._tests.values() if status == 'FAIL'])
+
+    @property
+    def passed_tests(self):
+        return len([status for status in self._tests.values() if status == 'PASS'])
+
+    @property
+    def eta(self):
+        if not self.finished_tests:
+            return None
+        elapsed = time() - self._start_time
+        remaining = max(0, self.total_tests - self.finished_tests)
+        return timedelta(seconds=int(elapsed / self.finished_tests * remaining))
+
+    def fmt_update(self):
+        eta = self.eta
+        return 'tests {}/{} | passed {} | failed {} | suites {}/{} | eta {}'.format(
+            self.finished_tests, self.total_tests,
+            self.passed_tests,
+            self.failed_tests,
+            self._jobs, self.total_jobs,
+            '...' if eta is None else eta
+        )
+
+    def _handle(self, event):
+        if self._events is not None:
+            self._events.write(json.dumps(event) + '\n')
+        if event['event'] == 'end_test':
+            # a rerun replaces the status of the earlier attempt
+            self._tests[(event['result'], event['longname'])] = event['status']
+        elif event['event'] == 'end_job':
+            self._jobs += 1
+            if self.console:
+                logger.info('finished {}: {} passed, {} failed in {:.1f}s'.format(
+                    event['job'], event['passed'], event['failed'], event['elapsed']
+                ), also_console=True)
+            self._print(force=True)
+        self._print()
+
+    def _print(self, force=False):
+        if not self.console:
+            return
+        if not force and time() - self._last_print < self.interval:
+            return
+        self._last_print = time()
+        logger.info(self.fmt_update(), also_console=True)
+
+    def run(self):
+        if self.events_file:
+            self._events = open(self.events_file, 'a')
+        try:
+            while True:
+                event = self.queue.get()
+                if event is None:
+                    break
+                self._handle(event)
+        finally:
+            if self._events is not None:
+                self._events.close()
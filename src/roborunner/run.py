@@ -17,24 +17,26 @@ Python api, which can be found here:
 """
 from roborunner.config import Config
 from roborunner.device import BuildDeviceList
-from roborunner.executable_test_suite import ExecutableTestSuite, BuildExecutableTestSuites
-from roborunner.test_suite_executor import TestSuiteExecutor
-from roborunner.log_tree import DeviceLogTree, SuiteLogTree
 
-from robot.api import ResultWriter, logger
+# robot and the modules built on it are imported by the functions that use
+# them, so --help, a wrong argument or a subcommand do not wait for robot
+# to import its running and result machinery
 
 from os import makedirs, path, getcwd
 from os import system as os_system
+from time import sleep, time
 import json
 import sys
 
 def log_config(config):
+    from robot.api import logger
     logger.info(
         'Running tests with configuration: {}'.format(json.dumps(config, indent=4, sort_keys=True)),
         also_console=True
     )
 
 def log_devices(devices):
+    from robot.api import logger
     devices_fmt = ''
     for device in devices:
         devices_fmt += '\n{}'.format(json.dumps(device, indent=4, sort_keys=True))
@@ -43,25 +45,172 @@ def log_devices(devices):
         also_console=True
     )
 
+def log_plan(executables):
+    from robot.api import logger
+    devices = sorted({executable.result_name for executable in executables})
+    test_counts = {}
+    for executable in executables:
+        key = (executable.test_name, executable.result_name)
+        test_counts[key] = test_counts.get(key, 0) + executable.test_count
+    test_names = sorted({test_name for test_name, _ in test_counts})
+    width = max([len('suite')] + [*map(len, test_names)])
+    plan_fmt = '\n{}  {}'.format(
+        'suite'.ljust(width),
+        '  '.join(devices)
+    )
+    for test_name in test_names:
+        plan_fmt += '\n{}  {}'.format(
+            test_name.ljust(width),
+            '  '.join(str(test_counts.get((test_name, device), '-')).rjust(len(device)) for device in devices)
+        )
+    logger.info(
+        'Execution plan: {} jobs running {} tests{}'.format(
+            len(executables), sum(test_counts.values()), plan_fmt
+        ),
+        also_console=True
+    )
+
+
+def execute(executables, config):
+    """
+    Runs the executables, or with --changed-only and --watch only those whose
+    inputs changed since they last passed, combines the outputs of all
+    executables into the log trees and adds the results to the history.
+
+    :return: a RunSummary of the jobs that ran
+    """
+    from roborunner.test_suite_executor import TestSuiteExecutor
+    from roborunner.log_tree import write_log_trees
+    from roborunner.changes import ChangeTracker
+    from roborunner.journal import RunJournal
+    from roborunner.job_result import RunSummary
+    from roborunner.history import record_run
+    from roborunner.tracing import tracer
+    from robot.api import logger
+
+    started = time()
+    tracker = None
+    jobs = executables
+    if config['changed_only'] or config['watch']:
+        tracker = ChangeTracker(config)
+        jobs = tracker.changed(executables)
+        logger.info(
+            'inputs of {} of {} jobs changed, reusing the outputs of the others'.format(
+                len(jobs), len(executables)
+            ),
+            also_console=True
+        )
+        if not jobs:
+            return RunSummary()
+    journal = RunJournal(config)
+    if not config['resume']:
+        journal.start()
+    summary = TestSuiteExecutor(jobs, config=config, journal=journal).run()
+    with tracer.span('merge logs'):
+        write_log_trees(executables, config)
+    journal.finish()
+    with tracer.span('record history'):
+        record_run(summary, config, started)
+    if tracker is not None:
+        tracker.record(jobs, summary)
+        tracker.save()
+    return summary
+
+
+def wait_for_changes(executables, config):
+    """
+    Blocks until a test file is added or removed, or a file of one
+    of the executables or a file they import is modified
+    """
+    from roborunner.executable_test_suite import BuildExecutableTestSuites
+    from roborunner.changes import ChangeTracker
+    from robot.api import logger
+
+    tracker = ChangeTracker(config)
+
+    def snapshot():
+        files = set(BuildExecutableTestSuites._build_test_paths(config['test_file_paths']))
+        for source in {executable.source for executable in executables}:
+            files.update(tracker.files(source))
+        return {file_path: path.getmtime(file_path) if path.exists(file_path) else None
+                for file_path in files}
+
+    logger.info('watching for changes, press Ctrl+C to stop', also_console=True)
+    before = snapshot()
+    while True:
+        sleep(config['watch_interval'])
+        if snapshot() != before:
+            return
+
+
+def run_suites(config):
+    """
+    Plans and runs the suites of a parsed configuration, for using
+    roborunner from python rather than from the command line
+
+    :return: the RunSummary of the last run, or None when nothing ran
+    """
+    from roborunner.executable_test_suite import BuildExecutableTestSuites
+    from roborunner.parse_cache import ParseCache
+    from roborunner.tracing import tracer
+    from robot.api import logger
+    tracer.enabled = bool(config['trace'])
+    log_config(config)
+    makedirs(config['outputdir'], exist_ok=True)
+    with tracer.span('plan'):
+        devices = BuildDeviceList(config=config).build()
+        log_devices(devices)
+        executables = BuildExecutableTestSuites(devices=devices, config=config).build()
+        ParseCache(config).save()
+    log_plan(executables)
+    if config['dry_plan']:
+        return None
+    summary = None
+    while True:
+        if executables:
+            with tracer.span('execute'):
+                summary = execute(executables, config)
+        else:
+            logger.warn('no tests match the given filters, nothing to run')
+        if not config['watch']:
+            break
+        try:
+            wait_for_changes(executables, config)
+        except KeyboardInterrupt:
+            break
+        with tracer.span('plan'):
+            executables = BuildExecutableTestSuites(devices=devices, config=config).build()
+            ParseCache(config).save()
+        log_plan(executables)
+    if config['trace']:
+        tracer.write(config['trace'])
+    return summary
+
 
 def run(args=None):
     if not args:
         args = sys.argv[1:]
+    if args and args[0] == 'worker':
+        from roborunner.worker import run_worker
+        run_worker(args[1:])
+        return
+    if args and args[0] == 'benchmark':
+        from roborunner.benchmark import run_benchmark
+        run_benchmark(args[1:])
+        return
+    if args and args[0] == 'history':
+        from roborunner.history import run_history
+        run_history(args[1:])
+        return
     config = Config.parse_args(args)
     if not path.exists(config['devices_file']) and not config['local_device']:
         print('devices file {} does not exist'.format(config['devices_file']))
         sys.exit(1)
-    log_config(config)
-    makedirs(config['outputdir'], exist_ok=True)
-    devices = BuildDeviceList(config=config).build()
-    log_devices(devices)
-    executables = BuildExecutableTestSuites(devices=devices, config=config).build()
-    t = TestSuiteExecutor(executables, config=config)
-    t.run()
-    tree = SuiteLogTree(executables, name=config['top_level_name'], config=config)
-    tree.write()
-    tree = DeviceLogTree(executables, name=config['top_level_name'], config=config)
-    tree.write()
+    if config['executor'] == 'remote' and not config['authkey']:
+        print('the remote executor requires --authkey or $ROBORUNNER_AUTHKEY')
+        sys.exit(1)
+    if run_suites(config) is None:
+        return
     try:
         os_system("""
             osascript -e 'display notification "Tests finished in directory {}" with title "Roborunner"'
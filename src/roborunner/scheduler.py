@@ -0,0 +1,92 @@
+from roborunner.device import Device
+
+
+class DeviceScheduler:
+    """
+    Hands out executable test suites so that no device runs more suites
+    at once than its `slots` allow. Suites are handed out in the order
+    they were given, skipping those whose device is busy, so an idle
+    device never waits behind the queue of a busy one.
+    """
+
+    def __init__(self, suites):
+        self._pending = []
+        self._capacity = {}
+        self._running = {}
+        self._devices = {}
+        for suite in suites:
+            self.add(suite)
+
+    @staticmethod
+    def _device(suite):
+        return str(suite)
+
+    def add(self, suite):
+        device = self._device(suite)
+        self._capacity.setdefault(device, max(1, int(suite.slots)))
+        self._running.setdefault(device, 0)
+        self._devices.setdefault(device, suite)
+        self._pending.append(suite)
+
+    def slots(self, suite):
+        return self._capacity[self._device(suite)]
+
+    def has_capacity(self, device):
+        return self._running[device] < self._capacity[device]
+
+    def next(self):
+        """
+        :return: the first pending suite whose device has a free slot, or None
+        """
+        for index, suite in enumerate(self._pending):
+            device = self._device(suite)
+            if self.has_capacity(device):
+                self._running[device] += 1
+                return self._pending.pop(index)
+        return None
+
+    def free_device(self, exclude=(), require_capacity=True):
+        """
+        :param exclude: names of devices that should not be picked
+        :param require_capacity: only pick a device that has a free slot right now
+        :return: the device with a free slot and the least pending suites, or None
+        """
+        candidates = [
+            device for device in self._devices
+            if device not in exclude and (self.has_capacity(device) or not require_capacity)
+        ]
+        if not candidates:
+            return None
+        pending = [self._device(suite) for suite in self._pending]
+        device = min(candidates, key=pending.count)
+        return Device(slots=self._devices[device].slots, **self._devices[device])
+
+    def drain(self, device=None):
+        """
+        Removes and returns all pending suites, or only those of one device
+        """
+        if device is None:
+            pending, self._pending = self._pending, []
+            return pending
+        pending = [suite for suite in self._pending if self._device(suite) == device]
+        self._pending = [suite for suite in self._pending if self._device(suite) != device]
+        return pending
+
+    def release(self, suite):
+        self._running[self._device(suite)] -= 1
+
+    @property
+    def devices(self):
+        return [Device(slots=suite.slots, **suite) for suite in self._devices.values()]
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    @property
+    def running(self):
+        return sum(self._running.values())
+
+    @property
+    def done(self):
+        return not self._pending and not self.running
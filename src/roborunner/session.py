@@ -0,0 +1,102 @@
+"""
+Device sessions that outlive a suite. With `--executor device` every device
+gets long-lived worker processes which run its suites one after another,
+and `--session-hook hooks.py` names a module with the functions that
+manage a session, e.g. an Appium or browser session:
+
+    def open_session(device):
+        return webdriver.Remote(device['appium_url'], desired_capabilities={...})
+
+    def session_alive(device, session):   # optional
+        return session.session_id is not None
+
+    def close_session(device, session):   # optional
+        session.quit()
+
+A library used by the suites opts in by asking for the session instead of
+opening its own. The session is opened on first use and reused by the
+next suites of the worker:
+
+    from roborunner.session import device_session
+
+    driver = device_session()
+
+session_alive is asked at most once per suite, a session that is not
+alive is closed and opened again. device_session() returns None when the
+suite does not run on a device worker or no hook is set.
+"""
+from importlib import import_module
+from importlib.util import spec_from_file_location, module_from_spec
+from os import path
+
+# the sessions of the device this process is pinned to
+_sessions = None
+
+
+def load_hook(name):
+    """
+    :param name: path of a python file, or name of an importable module
+    """
+    if name.endswith('.py') or path.isfile(name):
+        spec = spec_from_file_location('roborunner_session_hook', path.abspath(name))
+        hook = module_from_spec(spec)
+        spec.loader.exec_module(hook)
+        return hook
+    return import_module(name)
+
+
+class DeviceSessions:
+
+    def __init__(self, hook, device):
+        self.hook = hook
+        self.device = device
+        self.session = None
+        self._open = False
+        self._checked = False
+
+    def begin_job(self):
+        self._checked = False
+
+    def get(self):
+        if self._open and not self._checked and hasattr(self.hook, 'session_alive'):
+            if not self.hook.session_alive(self.device, self.session):
+                self.close()
+        self._checked = True
+        if not self._open:
+            self.session = self.hook.open_session(self.device)
+            self._open = True
+        return self.session
+
+    def close(self):
+        if not self._open:
+            return
+        self._open = False
+        session, self.session = self.session, None
+        if hasattr(self.hook, 'close_session'):
+            self.hook.close_session(self.device, session)
+
+
+def start(hook_name, device):
+    global _sessions
+    _sessions = DeviceSessions(load_hook(hook_name), device)
+
+
+def begin_job():
+    if _sessions is not None:
+        _sessions.begin_job()
+
+
+def stop():
+    global _sessions
+    if _sessions is not None:
+        _sessions.close()
+        _sessions = None
+
+
+def device_session():
+    """
+    :return: the session of the device this worker is pinned to, or None
+    """
+    if _sessions is None:
+        return None
+    return _sessions.get()
@@ -1,12 +1,21 @@
 from roborunner.config import Config
 from roborunner.executable_test_suite import ExecutableTestSuite
+from roborunner.timings import TimingDatabase
+from roborunner.scheduler import DeviceScheduler
+from roborunner.progress import ProgressReporter
+from roborunner.backends import BACKENDS
+from roborunner.device_health import DeviceHealth
+from roborunner.job_result import RunSummary
+from roborunner.concurrency import ConcurrencyController
+from roborunner.tracing import tracer
 
-from multiprocessing.pool import Pool
-from threading import Thread
+from multiprocessing import Manager
+from threading import Condition
+from functools import partial
+from queue import Queue
 from robot.api import logger, TestSuite
-from robot.conf import gatherfailed
 
-from time import sleep
+from time import time
 from os import path
 
 class TestSuiteExecutor:
@@ -14,9 +23,15 @@ class TestSuiteExecutor:
     @staticmethod
     def _error_callback(err):
         logger.error('executing test suite failed: {}'.format(err))
-        raise err
 
-    def __init__(self, ex_test_suites, config={}):
+    def __init__(self, ex_test_suites, config={}, journal=None):
+        """
+
+        :param ex_test_suites: the ExecutableTestSuites to run
+        :param config:
+        :param journal: optional RunJournal which records every finished job,
+            and provides the jobs that finished before with --resume
+        """
         if not isinstance(ex_test_suites, list):
             if isinstance(ex_test_suites[0], ExecutableTestSuite):
                 raise TypeError('ex_test_suites must be of type {}'.format(type(ExecutableTestSuite)))
@@ -26,61 +41,287 @@ class TestSuiteExecutor:
         self.suites = ex_test_suites
         self.processes = []
         self.failed_testcases = []
-    
-    def fmt_update(self, process, suite):
-        assert isinstance(suite, ExecutableTestSuite)
-        message = '{:<7}\t{test_name} on {device}'
-        score = '...'
-        if process.ready():
-            total = suite.test_count
-            passed = str(total - process.get())
-            score = '{}/{}'.format(
-                passed,
-                total
-            )
-        return message.format(
-            score,
-            test_name=suite.test_name,
-            device=str(suite)
+        self.summary = RunSummary()
+        self._journal = journal
+        self._timings = TimingDatabase(self.config)
+        self._scheduler = None
+        self._reporter = None
+        self._health = DeviceHealth(self.config.get('breaker_threshold') or 0)
+        self._concurrency = None
+        self._completed = []
+        self._in_flight = {}
+        self._submitted = {}
+        self._deadline = None
+        self._expired = False
+        self._finished = Condition()
+
+    def _start_reporter(self, queue, console):
+        self._reporter = ProgressReporter(
+            queue,
+            total_tests=sum(suite.test_count for suite in self.suites),
+            total_jobs=len(self.suites),
+            events_file=self.config.get('events_file'),
+            console=console
         )
+        self._reporter.start()
+
+    def _preflight(self):
+        if not self.config.get('preflight'):
+            return
+        devices = self._scheduler.devices
+        with tracer.span('preflight'):
+            self._health.preflight(devices, self.config['preflight'], timeout=self.config.get('preflight_timeout'))
+        for device in devices:
+            if self._health.is_tripped(device):
+                self._take_out_of_rotation(str(device))
+
+    def _take_out_of_rotation(self, device):
+        """
+        Moves the pending jobs of a device that was taken out of rotation to a
+        healthy device with --reroute-jobs, or fails their tests right away.
+        """
+        reason = self._health.tripped[device]
+        for suite in self._scheduler.drain(device):
+            target = None
+            if self.config.get('reroute_jobs'):
+                target = self._scheduler.free_device(exclude=self._health.tripped, require_capacity=False)
+            if target is not None:
+                moved = suite.moved_to(target)
+                logger.info('moving {} to {}'.format(suite.job_name, str(target)), also_console=True)
+                self._scheduler.add(moved)
+                continue
+            result = suite.write_failed_result(
+                'Not run: device {} was taken out of rotation, {}'.format(device, reason)
+            )
+            self._record(suite, result)
+
+    def _record(self, suite, result):
+        self.summary.add(result)
+        self._reporter.job_finished(suite.job_name, result)
 
-    def _log_update(self):
-        progress = 0
-        last_progress = -1
-        while progress < len(self.suites):
-            progress = 0
-            for process, suite in self.processes:
-                if process.ready():
-                    progress += 1
-            if last_progress != progress:
-                for process, suite in self.processes:
-                    logger.info(self.fmt_update(process, suite), also_console=True)
-                logger.info(
-                    'total test suites finished: {}/{}\n'.format(
-                        progress, len(self.suites)
-                    ),
-                    also_console=True
-                )
-            last_progress = progress
-            sleep(0.1)
-    
     def run(self):
-        if len(self.suites) <= 1 or self.config['max_processes'] == 1:
-            for suite in self.suites:
-                suite.run(verbose=True)
+        """
+        :return: a RunSummary with the results of all jobs, including reruns
+        """
+        if self._journal is not None and self.config.get('resume'):
+            self.suites = self._resume(self.suites)
+        if self.config['schedule'] == 'longest-first':
+            self.suites = self._timings.sort(self.suites)
+        if self.config.get('deadline'):
+            self._deadline = time() + self.config['deadline']
+        with tracer.span('run jobs'):
+            self._run()
+        self._timings.save()
+        return self.summary
+
+    def _resume(self, suites):
+        """
+        Takes the results of the jobs that finished before the run was interrupted
+        from the journal, and hands the last attempt of each job to the rerun
+        handling, so failed tests still get their remaining reruns.
+
+        :return: the suites that still have to run
+        """
+        remaining = []
+        for suite in suites:
+            results = self._journal.results(suite)
+            if not results:
+                remaining.append(suite)
+                continue
+            attempt = suite
+            for result in results:
+                if result is not results[0]:
+                    attempt = attempt.rerun([test['name'] for test in result['tests']])
+                self.summary.add(result)
+            self._completed.append((attempt, results[-1]))
+        logger.info('resuming the run, {} of {} jobs finished before'.format(
+            len(suites) - len(remaining), len(suites)
+        ), also_console=True)
+        return remaining
+
+    def _rerun(self, suite, result):
+        """
+        With --rerun-mode failed, creates the next attempt of a suite
+        which runs only its failed tests.
+
+        :return: the rerun suite, or None if nothing should be rerun
+        """
+        if not self.config['rerun_failed'] or self.config['rerun_mode'] != 'failed':
+            return None
+        if not result.return_code or suite.attempt >= self.config['rerun_attempts']:
+            return None
+        failed_tests = result.failed_tests
+        if not failed_tests:
+            return None
+        device = None
+        if self.config['rerun_on_other_device'] or self._health.is_tripped(suite):
+            device = self._scheduler.free_device(exclude=[str(suite), *self._health.tripped])
+            if device is None and self._health.is_tripped(suite):
+                return None
+        rerun = suite.rerun(failed_tests, device=device)
+        logger.info('rerunning {} failed tests of {}'.format(len(failed_tests), rerun.job_name),
+                    also_console=True)
+        return rerun
+
+    def _handle_completed(self):
+        completed, self._completed = self._completed, []
+        for suite, result in completed:
+            if self._health.record(suite, result):
+                self._take_out_of_rotation(str(suite))
+            rerun = self._rerun(suite, result)
+            if rerun is not None:
+                self._reporter.total_jobs += 1
+                self._scheduler.add(rerun)
+
+    @property
+    def _remaining(self):
+        """
+        :return: seconds until the deadline of the run, or None without a deadline
+        """
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - time())
+
+    def _job_timeout(self):
+        timeouts = [
+            timeout for timeout in (self.config.get('job_timeout'), self._remaining)
+            if timeout is not None
+        ]
+        return min(timeouts) if timeouts else None
+
+    def _concurrency_limit(self):
+        """
+        :return: how many jobs may run at once, adapted to the load of the
+            machine with --adaptive-concurrency
+        """
+        if self._concurrency is None:
+            return self.config['max_processes']
+        limit = self._concurrency.limit
+        if self._concurrency.update(self._scheduler.running, self._scheduler.pending) != limit:
+            tracer.counter('concurrency', limit=self._concurrency.limit)
+        return self._concurrency.limit
+
+    def _wait_timeout(self):
+        timeouts = [self._remaining]
+        if self._concurrency is not None:
+            timeouts.append(self._concurrency.interval)
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def _expire(self, backend):
+        """
+        Stops all running jobs once the deadline of the run has passed and writes
+        failed results for them and for the jobs that never started.
+        """
+        logger.error('the deadline of {} seconds was reached, stopping the run'
+                     .format(self.config['deadline']))
+        backend.terminate()
+        with self._finished:
+            self._expired = True
+            for suite in self._in_flight.values():
+                self._record(suite, suite.write_failed_result('Job was stopped at the deadline of the run'))
+            self._in_flight.clear()
+            for suite in self._scheduler.drain():
+                self._record(suite, suite.write_failed_result('Job did not start before the deadline of the run'))
+
+    def _run(self):
+        self._scheduler = DeviceScheduler(self.suites)
+        serial = len(self.suites) <= 1 or self.config['max_processes'] == 1
+        if self.config.get('session_hook') and self.config['executor'] != 'device':
+            logger.warn('--session-hook is only used by the device executor, no device sessions are opened')
+        if self.config.get('job_timeout') and self.config['executor'] == 'pool':
+            logger.warn('--job-timeout is not supported by the pool executor, jobs run until they finish')
+        if serial and self.config['executor'] == 'pool':
+            events = Queue()
+            self._start_reporter(events, console=False)
+            self._preflight()
+            self._handle_completed()
+            while not self._scheduler.done:
+                if self._remaining == 0:
+                    # a job running in this process cannot be stopped, the
+                    # deadline is checked before each job starts instead
+                    logger.error('the deadline of {} seconds was reached, stopping the run'
+                                 .format(self.config['deadline']))
+                    for suite in self._scheduler.drain():
+                        self._record(suite, suite.write_failed_result(
+                            'Job did not start before the deadline of the run'
+                        ))
+                    break
+                suite = self._scheduler.next()
+                self._submitted[id(suite)] = time()
+                self._job_done(suite, suite.run(verbose=True, events=events))
+                self._handle_completed()
+            self._reporter.stop()
             return
-        pool = Pool(processes=self.config['max_processes'])
+        manager = Manager()
+        events = manager.Queue()
+        backend = BACKENDS[self.config['executor']](self.config, events)
+        if self.config.get('adaptive_concurrency'):
+            if self.config['executor'] == 'remote':
+                logger.warn('--adaptive-concurrency is not supported by the remote executor')
+            else:
+                self._concurrency = ConcurrencyController(
+                    self.config.get('min_processes') or 1,
+                    self.config['max_processes'],
+                    self.config.get('adaptive_interval') or 5
+                )
         logger.info('starting execution of {} test suites on up to {} processes'
                     .format(len(self.suites), self.config['max_processes']), also_console=True)
-        for suite in self.suites:
-            new_process = pool.apply_async(
-                ExecutableTestSuite.run,
-                args=(suite,),
-                error_callback=TestSuiteExecutor._error_callback
+        self._start_reporter(events, console=True)
+        self._preflight()
+        self._handle_completed()
+        expired = False
+        with self._finished:
+            while not self._scheduler.done:
+                while self._scheduler.running < self._concurrency_limit():
+                    suite = self._scheduler.next()
+                    if suite is None:
+                        break
+                    self._submit(backend, suite)
+                self._finished.wait(timeout=self._wait_timeout())
+                self._handle_completed()
+                if self._remaining == 0:
+                    expired = True
+                    break
+        if expired:
+            self._expire(backend)
+        else:
+            backend.close()
+        self._reporter.stop()
+        manager.shutdown()
+
+    def _submit(self, backend, suite):
+        self._in_flight[id(suite)] = suite
+        self._submitted[id(suite)] = time()
+        tracer.counter('jobs', pending=self._scheduler.pending, running=self._scheduler.running)
+        new_process = backend.submit(
+            suite,
+            callback=partial(self._job_done, suite),
+            error_callback=partial(self._job_failed, suite),
+            timeout=self._job_timeout()
+        )
+        self.processes.append((new_process, suite))
+
+    def _job_done(self, suite, result):
+        with self._finished:
+            if self._in_flight.pop(id(suite), None) is None and self._expired:
+                # already given a failed result when the run expired
+                return
+            self._record(suite, result)
+            self._timings.record(suite, result)
+            if self._journal is not None:
+                self._journal.record(suite, result)
+            tracer.job(
+                result,
+                submitted=self._submitted.pop(id(suite), time()),
+                finished=time(),
+                slots=self._scheduler.slots(suite)
             )
-            self.processes.append((new_process, suite))
-        log_thread = Thread(name='log_update_thread', target=TestSuiteExecutor._log_update, args=(self,))
-        log_thread.start()
-        pool.close()
-        pool.join()
-        log_thread.join()
+            self._scheduler.release(suite)
+            tracer.counter('jobs', pending=self._scheduler.pending, running=self._scheduler.running)
+            self._completed.append((suite, result))
+            self._finished.notify()
+
+    def _job_failed(self, suite, err):
+        TestSuiteExecutor._error_callback(err)
+        self._job_done(suite, suite.write_failed_result('Executing the job failed: {}'.format(err)))
@@ -0,0 +1,90 @@
+from robot.api import logger
+
+from os import path, makedirs
+from hashlib import sha1
+import json
+
+# seconds per test used when there are no timings at all to estimate from
+DEFAULT_TEST_DURATION = 10.0
+
+
+class TimingDatabase:
+    """
+    Keeps the elapsed time of every executed suite between runs, so that
+    the longest jobs can be started first. The timings are taken from the
+    job results of each run and stored as json, keyed by the suite source,
+    the active test filter and the device.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.path = config.get('timings_file') or \
+            path.join(config['outputdir'], '.roborunner_timings.json')
+        self._timings = {}
+        if path.exists(self.path):
+            try:
+                with open(self.path, 'r') as timings_file:
+                    self._timings = json.loads(timings_file.read())
+            except (OSError, ValueError) as e:
+                logger.info('could not read timings file {}: {}'.format(self.path, e))
+
+    def key(self, suite):
+        tests = ''
+        if suite.tests is not None:
+            tests = sha1('\n'.join(suite.tests).encode('utf-8')).hexdigest()
+        key = [
+            path.abspath(suite.source),
+            self.config['debug_testcase'],
+            self.config['include_tags'],
+            tests,
+            str(suite)
+        ]
+        if suite.parameters:
+            key.append(suite.parameters)
+        return json.dumps(key)
+
+    @property
+    def seconds_per_test(self):
+        total_elapsed = sum(timing['elapsed'] for timing in self._timings.values())
+        total_tests = sum(timing['tests'] for timing in self._timings.values())
+        if not total_tests:
+            return DEFAULT_TEST_DURATION
+        return total_elapsed / total_tests
+
+    def estimate(self, suite):
+        """
+        :return: the expected duration of the suite in seconds, either from an
+            earlier run or from its test count and the average test duration
+        """
+        timing = self._timings.get(self.key(suite))
+        if timing is not None:
+            return timing['elapsed']
+        return suite.test_count * self.seconds_per_test
+
+    def sort(self, suites):
+        """
+        Orders the suites longest expected duration first, which keeps
+        long suites from being started last and setting the makespan.
+        """
+        estimates = {id(suite): self.estimate(suite) for suite in suites}
+        return sorted(suites, key=lambda suite: estimates[id(suite)], reverse=True)
+
+    def record(self, suite, result):
+        """
+        Records the elapsed time of a finished job. Reruns are not recorded,
+        as they only run a part of the suite, nor are the results written for
+        jobs that were killed or never ran.
+
+        :param result: the JobResult of the job
+        """
+        if suite.attempt or result.synthetic or not result.test_count:
+            return
+        self._timings[self.key(suite)] = {
+            'elapsed': result['elapsed'],
+            'tests': result.test_count
+        }
+
+    def save(self):
+        makedirs(path.dirname(path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'w') as timings_file:
+            timings_file.write(json.dumps(self._timings, indent=4, sort_keys=True))
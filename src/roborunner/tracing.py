@@ -0,0 +1,187 @@
+from robot.api import logger
+
+from contextlib import contextmanager
+from time import time
+from os import getpid, path
+import json
+
+
+@contextmanager
+def span(spans, name):
+    """
+    Appends the start and end of the enclosed block to spans, used in
+    workers where the spans travel back to the parent with the JobResult
+    """
+    start = time()
+    try:
+        yield
+    finally:
+        spans.append({'name': name, 'start': start, 'end': time()})
+
+
+class Tracer:
+    """
+    Records the phases of a run and the spans of every job as Chrome trace
+    events (chrome://tracing, ui.perfetto.dev). Phases of the parent process
+    show up on its main thread, every job on the row of the worker process
+    that ran it, together with the parse, robot and rerun spans inside it.
+    The summary shows how much of the slots of every device was left idle.
+    Nothing is recorded until the tracer is enabled with --trace.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.started = time()
+        self.pid = getpid()
+        self._jobs = []
+        self._phases = []
+        self._depth = 0
+        self._process_names = {self.pid: 'roborunner'}
+
+    def _ts(self, timestamp):
+        return int((timestamp - self.started) * 1000000)
+
+    def add(self, name, start, end, category='phase', pid=None, **args):
+        if not self.enabled:
+            return
+        pid = pid or self.pid
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': self._ts(start),
+            'dur': max(0, self._ts(end) - self._ts(start)),
+            'pid': pid,
+            'tid': pid,
+            'args': args
+        })
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        Records a phase of the parent process
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time()
+        phase = len(self._phases)
+        self._phases.append(None)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            end = time()
+            # nested phases are indented below the phase they are part of
+            self._phases[phase] = ('  ' * self._depth + name, end - start)
+            self.add(name, start, end, **args)
+
+    def counter(self, name, **values):
+        if not self.enabled:
+            return
+        self.events.append({
+            'name': name,
+            'ph': 'C',
+            'ts': self._ts(time()),
+            'pid': self.pid,
+            'args': values
+        })
+
+    def job(self, result, submitted, finished, slots=1):
+        """
+        Records a finished job from the spans its worker sent with the JobResult.
+        Results written for jobs that were killed or never ran are left out.
+
+        :param submitted: when the job was handed to the executor backend
+        :param finished: when the parent received its result
+        :param slots: how many jobs the device of the job runs at once
+        """
+        if not self.enabled or result.synthetic:
+            return
+        pid = result.get('pid') or self.pid
+        self._process_names.setdefault(pid, 'worker {}'.format(pid))
+        spans = result.get('spans') or []
+        job_span = [item for item in spans if item['name'] == 'job']
+        start = job_span[0]['start'] if job_span else submitted
+        end = job_span[0]['end'] if job_span else finished
+        self.add(
+            result['job'], start, end,
+            category='job',
+            pid=pid,
+            device=result['executed_on'],
+            worker=pid,
+            tests=len(result['tests']),
+            return_code=result['return_code']
+        )
+        for item in spans:
+            if item['name'] != 'job':
+                self.add(item['name'], item['start'], item['end'], category='job', pid=pid)
+        self._jobs.append({
+            'pid': pid,
+            'device': result['executed_on'],
+            'slots': slots,
+            'start': start,
+            'end': end,
+            'startup': max(0.0, start - submitted),
+            'collect': max(0.0, finished - end),
+            'busy': end - start,
+            'spans': spans
+        })
+
+    def write(self, trace_file):
+        """
+        Writes the trace-event json and a text summary next to it
+
+        :return: the text summary
+        """
+        events = [
+            {'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}}
+            for pid, name in self._process_names.items()
+        ]
+        with open(trace_file, 'w') as json_file:
+            json_file.write(json.dumps({'traceEvents': events + self.events, 'displayTimeUnit': 'ms'}))
+        summary = self.summary()
+        with open(path.splitext(trace_file)[0] + '.summary.txt', 'w') as summary_file:
+            summary_file.write(summary + '\n')
+        logger.info('trace written to {}\n{}'.format(trace_file, summary), also_console=True)
+        return summary
+
+    def summary(self):
+        lines = ['{:<30}{:>10}'.format('phase', 'seconds')]
+        for name, seconds in self._phases:
+            lines.append('{:<30}{:>10.2f}'.format(name, seconds))
+        if not self._jobs:
+            return '\n'.join(lines)
+        job_phases = {}
+        for job in self._jobs:
+            for item in job['spans']:
+                if item['name'] != 'job':
+                    job_phases[item['name']] = job_phases.get(item['name'], 0.0) + item['end'] - item['start']
+        lines.append('')
+        lines.append('{:<30}{:>10}'.format('{} jobs, summed'.format(len(self._jobs)), 'seconds'))
+        lines.append('{:<30}{:>10.2f}'.format('startup', sum(job['startup'] for job in self._jobs)))
+        for name, seconds in sorted(job_phases.items()):
+            lines.append('{:<30}{:>10.2f}'.format(name, seconds))
+        lines.append('{:<30}{:>10.2f}'.format('collect', sum(job['collect'] for job in self._jobs)))
+        # idle time of the slots of every device while any job was running,
+        # the processes that run jobs differ between executors
+        total = max(job['end'] for job in self._jobs) - min(job['start'] for job in self._jobs)
+        busy = {}
+        slots = {}
+        for job in self._jobs:
+            busy[job['device']] = busy.get(job['device'], 0.0) + job['busy']
+            slots[job['device']] = job['slots']
+        lines.append('')
+        lines.append('{:<30}{:>10}{:>8}'.format('device', 'busy', 'idle'))
+        for device, seconds in sorted(busy.items()):
+            capacity = total * slots[device]
+            lines.append('{:<30}{:>10.2f}{:>7.0f}%'.format(
+                device, seconds, 100 * max(0.0, 1 - seconds / capacity) if capacity else 0
+            ))
+        return '\n'.join(lines)
+
+
+# the tracer of this process, written at the end of the run with --trace
+tracer = Tracer()
@@ -0,0 +1,152 @@
+"""
+Runs jobs of a coordinator started with `--executor remote`, usually on
+another host with its own devices attached:
+
+    roborunner worker --coordinator host:port --devices devices.json --outputdir results
+
+The worker owns the devices of its devices file and gets only their jobs.
+Test files are read from the same relative paths as on the coordinator, so
+workers are started in a checkout of the same tests. Jobs run like with the
+subprocess executor, their outputs are written to the local outputdir and
+sent to the coordinator. The worker reconnects when the coordinator goes
+away, so it can serve one run after another until it is interrupted.
+Coordinator and workers authenticate with the key given with --authkey or
+$ROBORUNNER_AUTHKEY, which both of them require.
+"""
+from roborunner.config import Config
+from roborunner.device import BuildDeviceList
+from roborunner.executable_test_suite import ExecutableTestSuite
+from roborunner.backends import SubprocessBackend, parse_address
+
+from robot.api import logger
+
+from multiprocessing.connection import Client
+from multiprocessing import AuthenticationError
+from functools import partial
+from threading import Lock
+from socket import gethostname
+from os import path, getpid, makedirs
+from time import sleep
+import sys
+
+# seconds between attempts to reach the coordinator
+RECONNECT_INTERVAL = 2
+
+
+class ConnectionQueue:
+    """
+    Stand-in for the event queue of the executors
+    which sends every event to the coordinator.
+    """
+
+    def __init__(self, send):
+        self.send = send
+
+    def put(self, event):
+        self.send(('event', event))
+
+
+class Worker:
+
+    def __init__(self, config):
+        self.config = config
+        self.name = '{}-{}'.format(gethostname(), getpid())
+        self.devices = [str(device) for device in BuildDeviceList(config=config).build()]
+        self._send_lock = Lock()
+
+    def serve(self):
+        """
+        Takes jobs from the coordinator, reconnecting whenever the connection ends
+        """
+        logger.info('worker {} with devices {} connecting to {}'.format(
+            self.name, ', '.join(self.devices), self.config['coordinator']
+        ), also_console=True)
+        while True:
+            try:
+                connection = Client(
+                    parse_address(self.config['coordinator']),
+                    authkey=self.config['authkey'].encode('utf-8')
+                )
+            except AuthenticationError:
+                logger.error('{} refused the authkey of this worker'.format(self.config['coordinator']))
+                sys.exit(1)
+            except (OSError, EOFError):
+                # not listening yet, or closed while the connection was authenticated
+                sleep(RECONNECT_INTERVAL)
+                continue
+            logger.info('connected to {}'.format(self.config['coordinator']), also_console=True)
+            try:
+                self._session(connection)
+            finally:
+                connection.close()
+
+    def _session(self, connection):
+        def send(message):
+            with self._send_lock:
+                connection.send(message)
+
+        send(('hello', self.name, self.devices))
+        backend = None
+        while True:
+            try:
+                message = connection.recv()
+            except (OSError, EOFError):
+                logger.warn('lost the connection to the coordinator, stopping its jobs')
+                if backend is not None:
+                    backend.terminate()
+                return
+            if message[0] == 'config':
+                # jobs run with the config of the coordinator and write to the local outputdir
+                job_config = Config(**message[1])
+                job_config['outputdir'] = self.config['outputdir']
+                backend = SubprocessBackend(job_config, ConnectionQueue(send))
+            elif message[0] == 'job':
+                _, job_id, job, timeout = message
+                suite = ExecutableTestSuite.from_job(job, backend.config)
+                backend.submit(
+                    suite,
+                    callback=partial(self._job_done, send, job_id, suite),
+                    error_callback=partial(self._job_failed, send, job_id, suite),
+                    timeout=timeout
+                )
+            elif message[0] == 'stop':
+                if backend is not None:
+                    backend.terminate()
+                return
+            elif message[0] == 'close':
+                if backend is not None:
+                    backend.close()
+                return
+
+    def _job_done(self, send, job_id, suite, result):
+        """
+        Sends the output files of a finished job to the coordinator, then its JobResult
+        """
+        output_base = path.splitext(path.join(suite.outputdir, suite.output))[0]
+        try:
+            for file_path in (suite.result_path, output_base + '.out', output_base + '.err'):
+                if not path.exists(file_path):
+                    continue
+                with open(file_path, 'rb') as output_file:
+                    data = output_file.read()
+                send(('file', path.relpath(file_path, self.config['outputdir']), data))
+            send(('result', job_id, result))
+        except (OSError, ValueError) as e:
+            logger.info('could not send the results of {}: {}'.format(suite.job_name, e))
+
+    def _job_failed(self, send, job_id, suite, err):
+        logger.error('{} failed on worker {}: {}'.format(suite.job_name, self.name, err))
+        result = suite.write_failed_result('Executing the job failed on worker {}: {}'.format(self.name, err))
+        self._job_done(send, job_id, suite, result)
+
+
+def run_worker(args):
+    config = Config.parse_args(args)
+    if not config['authkey']:
+        print('roborunner worker requires --authkey or $ROBORUNNER_AUTHKEY')
+        sys.exit(1)
+    makedirs(config['outputdir'], exist_ok=True)
+    try:
+        Worker(config).serve()
+    except KeyboardInterrupt:
+        pass